@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
+import shutil
+import sys
+import threading
 import colorama
+import branch_metadata
+import cherry_picker
+import git_client
+import git_refs
+from branch_index import BranchIndex
+from metadata_cache import MetadataCache
 
 SOURCE_LOCAL = 'locally checked branches'
-SOURCE_REMOTE = 'all remote branches'  # no supported yet
+SOURCE_REMOTE = 'all remote branches'
+DEFAULT_SCREEN_ROWS = 40
+BACKGROUND_CHUNK = 500
+LOADING_PLACEHOLDER = '...'
 
 
 class BranchFilter:
@@ -14,54 +25,138 @@ class BranchFilter:
                  synthetic_branches: [dict] = None, # custom not existent branches
                  input_provider=lambda: input().lower(),
                  cwd=os.path.abspath(''),
-                 initial_input:str=None):
+                 initial_input:str=None,
+                 known_branches: [branch_metadata.BranchMeta] = None, # already loaded local branches
+                 source: str = SOURCE_LOCAL):
         self.cwd = cwd
+        self.source = source
         self.provide_input = input_provider
         self.all_branches: list[str] = []
         self._initial_input = initial_input
         self._flow_initial_input = None
-        branches_str = self.capture_output('git branch')
+        self._cache = MetadataCache(cwd)
+        # branches which head commits are not known yet mapped to revisions that resolve them
+        self._revisions = {}
+        # subset of `_revisions` resolved by background loader, the rest are resolved once displayed or selected
+        background = {}
+        self._remote_branches = set()
 
         if custom_branches:
             self.all_branches: list[str] = custom_branches
+        elif source == SOURCE_REMOTE:
+            known_branches = branch_metadata.list_branches(cwd, git_refs.REMOTE_PREFIX, cache=self._cache)
+            known_branches = list(filter(lambda b: not b.name.endswith('/HEAD'), known_branches))
+            self.all_branches = sorted(map(lambda b: b.name, known_branches), reverse=True)
+            self._remote_branches = set(self.all_branches)
         elif not synthetic_branches:
+            if known_branches is None:
+                known_branches = branch_metadata.list_branches(cwd, cache=self._cache)
             # TODO sorted(key=lambda key: sort_case)
-            self.all_branches: list[str] = branches_str.replace('* ', '').replace(' ', '').splitlines()
-            self.all_branches = sorted(self.all_branches, reverse=True)
+            self.all_branches = sorted(map(lambda b: b.name, known_branches), reverse=True)
 
         self.head_commits = {} #map here!
+        if not custom_branches and known_branches:
+            for b in known_branches:
+                if b.subject is not None:
+                    self.head_commits[b.name] = b.subject
+                elif source == SOURCE_REMOTE:
+                    self._revisions[b.name] = b.sha
+                else:
+                    background[b.name] = b.sha
 
         if synthetic_branches:
             for s in synthetic_branches:
                 branch_name = s['name']
                 commit_msg = s['commit']
-                if not commit_msg:
-                    commit_msg = self._get_commit_message(s['ref'])
-                self.head_commits[branch_name] = commit_msg
+                if commit_msg:
+                    self.head_commits[branch_name] = commit_msg
+                else:
+                    background[branch_name] = s['ref']
                 self.all_branches.append(branch_name)
 
         self.remaining_branches = list(self.all_branches)
 
         for branch in self.all_branches:
-            if branch in self.head_commits:
+            if branch in self.head_commits or branch in background or branch in self._revisions:
                 continue
-            self.head_commits[branch] = self._get_commit_message(branch+'~0')
+            background[branch] = branch + '~0'
+        self._revisions.update(background)
+        self.index = BranchIndex(self.all_branches, self.head_commits)
 
         self.selected_branches = []
         self.selection_finished = False
+        self._name_width = None
+        self._query_chain = []
+        self._subjects_version = 0
+        self._narrowed_version = 0
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._selection_done = threading.Event()
+        self._loader = threading.Thread(target=self._load_in_background, args=(list(background.items()),), daemon=True)
+        self._loader.start()
 
-    def _get_commit_message(self, revision: str) -> str:
+    def wait_until_loaded(self) -> None:
+        """Blocks until background loader resolves head commits of all branches (except lazy remote ones)."""
+        self._loaded.wait()
+
+    def _load_in_background(self, pending: [(str, str)]) -> None:
         try:
-            full_commit_log = self.capture_output('git show -s --format=%B $(git rev-parse ' + revision + ')')
-            fisrt_return = full_commit_log.index('\n')
-            full_commit_log = full_commit_log[0:fisrt_return]
-        except:
-            full_commit_log = '<BRANCH NOT FOUND>'
-            pass
-        return full_commit_log
+            for chunk_start in range(0, len(pending), BACKGROUND_CHUNK):
+                if self._selection_done.is_set():
+                    break
+                self._resolve_commit_messages(pending[chunk_start:chunk_start + BACKGROUND_CHUNK])
+        finally:
+            # written once and outside of lock, so keystrokes never wait for disk; before signalling that messages
+            # are loaded, so cache is complete once anybody stops waiting (process may exit right after)
+            try:
+                self._save_cache()
+            finally:
+                self._loaded.set()
+
+    def _ensure_commit_messages(self, branches: [str]) -> None:
+        with self._lock:
+            missing = list(map(lambda b: (b, self._revisions[b]), filter(lambda b: b not in self.head_commits, branches)))
+        if len(missing) > 0:
+            self._resolve_commit_messages(missing)
+            self._save_cache()
+
+    def _resolve_commit_messages(self, revisions: [(str, str)]) -> None:
+        resolved = branch_metadata.resolve_revisions(self.cwd, list(map(lambda e: e[1], revisions)))
+        with self._lock:
+            for branch, revision in revisions:
+                if branch in self.head_commits:
+                    continue
+                meta = resolved[revision]
+                self.head_commits[branch] = meta.subject if meta else branch_metadata.BRANCH_NOT_FOUND
+                self.index.update_subject(branch, self.head_commits[branch])
+                if meta:
+                    self._cache.put(meta.sha, subject=meta.subject, author=meta.author, date=meta.date)
+            self._subjects_version += 1
+
+    def _save_cache(self) -> None:
+        with self._save_lock:
+            self._cache.save()
+
+    def _finish_selection(self) -> None:
+        # messages of not selected branches are no longer needed, loader stops after current chunk
+        self._selection_done.set()
+        self._loader.join()
+        self._ensure_commit_messages(self.selected_branches)
+
+    def as_local_branch(self, branch: str) -> str:
+        """Returns local branch to checkout for selected one, remote branches get local tracking branch created.
+
+        Returns None when user declines switching to existing local branch which does not match remote one.
+        """
+        if branch not in self._remote_branches:
+            return branch
+        return create_tracking_branch(branch, self.cwd, self.provide_input)
 
     def extend_selected(self, selected):
         self.selected_branches.extend(selected)
+        selected = set(selected)
+        self.remaining_branches = list(filter(lambda b: b not in selected, self.remaining_branches))
 
     def find_many(self):
         self._flow_initial_input = self._initial_input
@@ -71,6 +166,7 @@ class BranchFilter:
             finish_criterion=lambda: self.selection_finished
         )
 
+        self._finish_selection()
         return self.selected_branches
 
     def find_one(self):
@@ -81,56 +177,82 @@ class BranchFilter:
             finish_criterion=lambda: len(self.selected_branches) == 1
         )
 
+        self._finish_selection()
         return self.selected_branches[0]
 
     def run_flow(self, flow_message, input_handler, finish_criterion):
-        if self._flow_initial_input:
-            input_handler(self._flow_initial_input.lower())
-            self._flow_initial_input = None
-        else: 
-            flow_message()
-            input_handler(self.provide_input().lower())
-
-        if finish_criterion():
-            return
+        while True:
+            if self._flow_initial_input:
+                input_handler(self._flow_initial_input.lower())
+                self._flow_initial_input = None
+            else:
+                flow_message()
+                user_input = self.provide_input().lower()
+                input_handler(user_input)
 
-        self.run_flow(flow_message, input_handler, finish_criterion)
+            if finish_criterion():
+                return
 
     def add_remaining_and_check_input(self, input):
-        for candidate in self.all_branches:
-            if input == '':
-                continue
-
-            if candidate in self.selected_branches:
-                continue
-            
-            if input not in candidate.lower() and input not in self.head_commits[candidate].lower():
-                continue
-
-            self.selected_branches.append(candidate)
-            self.remaining_branches.remove(candidate)
         self.selection_finished = input == ''
+        if self.selection_finished:
+            return
+
+        # explicit selection should not miss branches which messages are still loading
+        self.wait_until_loaded()
+        with self._lock:
+            matched = self.index.search(input, within=self.remaining_branches)
+        self.selected_branches.extend(matched)
+        matched = set(matched)
+        self.remaining_branches = list(filter(lambda b: b not in matched, self.remaining_branches))
 
     def find_single_branch(self, input):
         if len(self.selected_branches) == 0:
-            filtered_branches = self.all_branches
-        else:
-            filtered_branches = self.selected_branches
-        self.selected_branches = list(
-            filter(lambda branch: input in self.head_commits[branch].lower() or input in branch.lower(),
-                   filtered_branches))
+            self._query_chain = []
+        self._query_chain.append(input)
+
+        with self._lock:
+            if self._narrowed_version == self._subjects_version:
+                self.selected_branches = self._narrow(input, self.selected_branches)
+            else:
+                # messages arrived since previous input, so earlier queries may match more now
+                self.selected_branches = self._narrow_chain()
+            self._narrowed_version = self._subjects_version
+
+        is_exact = len(self.selected_branches) == 1 and self.selected_branches[0].lower() == input
+        if len(self.selected_branches) <= 1 and not is_exact and not self._loaded.is_set():
+            # unique (or no) match by names only is not certain until all messages are loaded
+            self.wait_until_loaded()
+            with self._lock:
+                self.selected_branches = self._narrow_chain()
+                self._narrowed_version = self._subjects_version
+
+    def _narrow_chain(self) -> [str]:
+        narrowed = []
+        for query in self._query_chain:
+            narrowed = self._narrow(query, narrowed)
+        return narrowed
+
+    def _narrow(self, query: str, previous: [str]) -> [str]:
+        narrowed = self.index.search(query, within=previous if len(previous) > 0 else None)
+        if len(narrowed) > 0 and narrowed[0].lower() == query:
+            # exact name match is ranked first and wins over partial matches
+            return narrowed[:1]
+        return narrowed
 
     def print_remains_and_selected(self):
-        print("\nRemaining:")
-        for branch in self.remaining_branches:
-            self.print_branch_desc(branch)
+        rows_left = self._screen_rows() - 8
+        selected = self._branch_rows(self.selected_branches, rows_left // 2)
+        remaining = self._branch_rows(self.remaining_branches, rows_left - len(selected))
 
-        print("\nSelected:")
-        print(colorama.Fore.RED)
-        for branch in self.selected_branches:
-            self.print_branch_desc(branch)
-        print(colorama.Fore.RESET)
-        print('\nType part of branch name or commit message to keep it or empty line to end selection:')
+        lines = ['\nRemaining:']
+        lines.extend(remaining)
+        lines.append('\nSelected:')
+        lines.append(colorama.Fore.RED)
+        lines.extend(selected)
+        lines.append(colorama.Fore.RESET)
+        lines.append('\nType part of branch name or commit message to keep it or empty line to end selection:')
+        self._write(lines)
 
     def print_remains_or_selected(self):
         if len(self.selected_branches) > 0:
@@ -138,19 +260,66 @@ class BranchFilter:
         else:
             branches_to_print = self.remaining_branches
 
-        for branch in branches_to_print:
-            self.print_branch_desc(branch)
-
-        print('\n( found:', len(self.selected_branches), ')')
-        print('\nType part of branch name or commit message to keep it or empty line to end search:')
+        lines = self._branch_rows(branches_to_print, self._screen_rows() - 5)
+        lines.append('\n( found: ' + str(len(self.selected_branches)) + ' )')
+        lines.append('\nType part of branch name or commit message to keep it or empty line to end search:')
+        self._write(lines)
 
     def print_branch_desc(self, branch):
-        branch_with_max_len = max(self.all_branches, key=len)
-        padding_str = ''
+        self._write([self.format_branch_desc(branch)])
+
+    def format_branch_desc(self, branch) -> str:
+        if self._name_width is None:
+            self._name_width = max(map(len, self.all_branches), default=0)
+        return branch.ljust(self._name_width) + ' | ' + self.head_commits.get(branch, LOADING_PLACEHOLDER)
+
+    def _branch_rows(self, branches: [str], limit: int) -> [str]:
+        """Formats only rows that fit to `limit`, the rest is summarized with single line."""
+        limit = max(limit, 1)
+        visible = branches if len(branches) <= limit else branches[:limit - 1]
+        self._ensure_commit_messages(list(filter(lambda b: b in self._remote_branches, visible)))
+        if len(branches) <= limit:
+            return list(map(self.format_branch_desc, branches))
+        rows = list(map(self.format_branch_desc, visible))
+        rows.append('... and ' + str(len(branches) - limit + 1) + ' more (type to narrow)')
+        return rows
+
+    @staticmethod
+    def _screen_rows() -> int:
+        return shutil.get_terminal_size(fallback=(80, DEFAULT_SCREEN_ROWS)).lines
+
+    @staticmethod
+    def _write(lines: [str]) -> None:
+        # whole screen goes out with single write instead of print() per row
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+
+def create_tracking_branch(remote_branch: str, cwd: str, input_provider=lambda: input().lower()) -> str:
+    """Returns local branch tracking `remote_branch` (like `origin/feature`), creates it unless it exists.
+
+    Existing branch without upstream starts tracking `remote_branch`. Switching to existing branch which tracks
+    another branch or diverged from `remote_branch` has to be confirmed, None is returned when it is not.
+    """
+    git = git_client.for_repo(cwd)
+    local_branch = remote_branch[remote_branch.index('/') + 1:]
+    remote_ref = git_refs.REMOTE_PREFIX + remote_branch
+    if local_branch not in git_refs.RefReader(cwd).branches():
+        git.run(['branch', '--track', local_branch, remote_ref])
+        return local_branch
 
-        for i in range(0, len(branch_with_max_len) - len(branch)):
-            padding_str = padding_str + ' '
-        print(branch + padding_str + ' | ' + self.head_commits[branch])
+    upstream = git.run(['rev-parse', '--abbrev-ref', local_branch + '@{upstream}'], check=False)
+    if upstream.returncode != 0:
+        git.run(['branch', '--quiet', '--set-upstream-to=' + remote_ref, local_branch])
+        print('Branch "' + local_branch + '" set up to track "' + remote_branch + '".')
+    elif upstream.stdout.strip() != remote_branch:
+        question = ('Local branch "' + local_branch + '" tracks "' + upstream.stdout.strip() + '", not "' +
+                    remote_branch + '". Switch to it anyway?')
+        return local_branch if cherry_picker.query_yes_no(question, input_provider, default='no') == 'yes' else None
 
-    def capture_output(self, cmd):
-        return subprocess.check_output(cmd, cwd=self.cwd, universal_newlines=True, shell=True)
+    ahead, behind = git.output(['rev-list', '--left-right', '--count', local_branch + '...' + remote_ref]).split()
+    if int(ahead) > 0 and int(behind) > 0:
+        question = ('Local branch "' + local_branch + '" has diverged from "' + remote_branch + '" (' + ahead +
+                    ' ahead, ' + behind + ' behind). Switch to it anyway?')
+        return local_branch if cherry_picker.query_yes_no(question, input_provider, default='no') == 'yes' else None
+    return local_branch
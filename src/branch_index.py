@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+NGRAM = 3
+
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_NAME = 2
+RANK_SUBJECT = 3
+
+
+class BranchIndex:
+    """Case-insensitive search over branch names and head commit subjects.
+
+    Names and subjects are lowercased once. Trigram postings are built once for all strings and intersected
+    to get candidates, so no query ever scans strings that cannot match.
+    Results are ranked: exact name, name prefix, name substring, subject match.
+    """
+
+    def __init__(self, branches: [str], subjects: {}) -> None:
+        self._branches = list(branches)
+        self._ids = dict(map(lambda e: (e[1], e[0]), enumerate(self._branches)))
+        self._names = list(map(lambda b: b.lower(), self._branches))
+        self._subjects = list(map(lambda b: (subjects.get(b, None) or '').lower(), self._branches))
+        self._haystacks = list(map(lambda e: e[0] + '\n' + e[1], zip(self._names, self._subjects)))
+        self._postings = {}
+        for i, haystack in enumerate(self._haystacks):
+            self._index(i, haystack)
+
+    def update_subject(self, branch: str, subject: str) -> None:
+        i = self._ids[branch]
+        for ngram in self._ngrams(self._haystacks[i]):
+            self._postings[ngram].discard(i)
+        self._subjects[i] = (subject or '').lower()
+        self._haystacks[i] = self._names[i] + '\n' + self._subjects[i]
+        self._index(i, self._haystacks[i])
+
+    def _index(self, i: int, haystack: str) -> None:
+        for ngram in self._ngrams(haystack):
+            self._postings.setdefault(ngram, set()).add(i)
+
+    def search(self, query: str, within: [str] = None) -> [str]:
+        """Returns ranked branches matching `query`, optionally narrowed to previous results `within`."""
+        query = query.lower()
+        if len(query) >= NGRAM:
+            postings = sorted(map(self._posting, self._ngrams(query)), key=len)
+            narrowed = postings[0].intersection(*postings[1:])
+            if within is None:
+                candidates = sorted(narrowed)  # only strings sharing all trigrams are visited
+            else:
+                candidates = filter(lambda i: i in narrowed, map(lambda b: self._ids[b], within))
+        elif within is None:
+            candidates = range(len(self._branches))  # shorter than trigram, nothing to narrow by
+        else:
+            candidates = map(lambda b: self._ids[b], within)
+
+        ranked = []
+        for i in candidates:
+            rank = self._rank(i, query)
+            if rank is not None:
+                ranked.append((rank, i))
+        ranked.sort()
+        return list(map(lambda e: self._branches[e[1]], ranked))
+
+    def _rank(self, i: int, query: str) -> int:
+        name = self._names[i]
+        if name == query:
+            return RANK_EXACT
+        if name.startswith(query):
+            return RANK_PREFIX
+        if query in name:
+            return RANK_NAME
+        if query in self._subjects[i]:
+            return RANK_SUBJECT
+        return None
+
+    def _posting(self, ngram: str) -> set:
+        return self._postings.get(ngram, set())
+
+    @staticmethod
+    def _ngrams(text: str) -> set:
+        return set(map(lambda start: text[start:start + NGRAM], range(0, len(text) - NGRAM + 1)))
+
+
+def resolve_by_name(query: str, branches: [str]) -> str:
+    """Resolves `query` against branch names only: exact name, then unique prefix, then unique substring.
+
+    Returns None when query is ambiguous or matches nothing, so caller has to fallback to full search.
+    """
+    if not query:
+        return None
+    query = query.lower()
+    names = list(map(lambda b: (b.lower(), b), branches))
+    for name, branch in names:
+        if name == query:
+            return branch
+    for matches in (lambda name: name.startswith(query), lambda name: query in name):
+        found = list(filter(lambda e: matches(e[0]), names))
+        if len(found) == 1:
+            return found[0][1]
+        if len(found) > 1:
+            return None
+    return None
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import git_client
+import git_refs
+from metadata_cache import MetadataCache
+
+BRANCH_NOT_FOUND = '<BRANCH NOT FOUND>'
+LOCAL_BRANCHES = git_refs.LOCAL_PREFIX
+
+
+class BranchMeta:
+    def __init__(self, name: str, sha: str, subject: str, author: str = None, date: int = None) -> None:
+        self.name = name
+        self.sha = sha
+        self.subject = subject
+        self.author = author
+        self.date = date
+
+    def __repr__(self) -> str:
+        return 'BranchMeta(' + self.name + ', ' + self.sha + ', ' + self.subject + ')'
+
+
+def list_branches(cwd: str, ref_pattern: str = LOCAL_BRANCHES, cache: MetadataCache = None) -> [BranchMeta]:
+    """Lists names and tip hashes of all branches without spawning git.
+
+    Refs are read from `.git` by `git_refs.RefReader`, head commit metadata is filled only for tips
+    already known to `cache`, the rest have `subject` set to None.
+    """
+    tips = git_refs.RefReader(cwd).branches(ref_pattern)
+    branches = []
+    for name, sha in tips.items():
+        entry = cache.get(sha) if cache is not None else None
+        if entry:
+            branches.append(BranchMeta(name=name, sha=sha, subject=entry['subject'],
+                                       author=entry['author'], date=entry['date']))
+        else:
+            branches.append(BranchMeta(name=name, sha=sha, subject=None))
+    return branches
+
+
+def load_branches(cwd: str, ref_pattern: str = LOCAL_BRANCHES, use_cache: bool = True) -> [BranchMeta]:
+    """Lists names, tip hashes and head commit metadata of all branches.
+
+    Same as `list_branches` but commits which tips are not in `MetadataCache` yet
+    are resolved with single `git cat-file --batch` session.
+    """
+    cache = MetadataCache(cwd) if use_cache else None
+    branches = list_branches(cwd, ref_pattern, cache=cache)
+    missing = list(map(lambda b: b.sha, filter(lambda b: b.subject is None, branches)))
+    resolved = resolve_revisions(cwd, missing, cache=cache)
+    for b in branches:
+        if b.subject is None:
+            meta = resolved[b.sha]
+            b.subject, b.author, b.date = meta.subject, meta.author, meta.date
+    if cache is not None:
+        cache.save()
+    return branches
+
+
+def resolve_revisions(cwd: str, revisions: [str], cache: MetadataCache = None) -> {}:
+    """Resolves arbitrary revisions (like `branch~2`) with shared `git cat-file --batch` coprocess.
+
+    Returns map of revision to `BranchMeta` (named by revision) or None if revision is missing.
+    Resolved commits are stored to `cache` if one given.
+    """
+    unique_revisions = list(dict.fromkeys(revisions))
+    if len(unique_revisions) == 0:
+        return {}
+    objects = git_client.for_repo(cwd).read_objects(list(map(lambda r: r + '^{commit}', unique_revisions)))
+    results = {}
+    for revision, found in zip(unique_revisions, objects):
+        if found is None:
+            results[revision] = None
+            continue
+        sha, _, contents = found
+        subject, author, date = parse_commit(contents.decode(errors='replace'))
+        results[revision] = BranchMeta(name=revision, sha=sha, subject=subject, author=author, date=date)
+        if cache is not None:
+            cache.put(sha, subject=subject, author=author, date=date)
+    return results
+
+
+def parse_commit(commit_object: str) -> (str, str, int):
+    """Extracts subject (the same way `%(contents:subject)` does), author and author date of raw commit object."""
+    header_end = commit_object.find('\n\n')
+    if header_end == -1:
+        header_end = len(commit_object)
+    author, date = None, None
+    for line in commit_object[:header_end].splitlines():
+        if line.startswith('author '):
+            # author Name <email> 1700000000 +0000
+            identity, timestamp, _ = line[len('author '):].rsplit(' ', 2)
+            author, date = identity, int(timestamp)
+            break
+
+    message = commit_object[header_end + 2:]
+    subject_end = message.find('\n\n')
+    if subject_end != -1:
+        message = message[:subject_end]
+    return ' '.join(message.strip().splitlines()), author, date
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable
+from revision_resolver import branch_of
+
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+def dependencies(outputs: [str], reads: [set]) -> {}:
+    """Maps index of each build item to indexes of earlier items it has to wait for.
+
+    `outputs[i]` is branch rebuilt by item `i` and `reads[i]` are branches it reads (basement and contents).
+    Item depends on earlier one which rebuilds branch it reads, reads branch it rebuilds or rebuilds the same branch,
+    so every branch is read in the same state as with sequential build.
+    """
+    result = {}
+    for later in range(len(outputs)):
+        result[later] = set(filter(lambda earlier: outputs[earlier] in reads[later] or
+                                   outputs[later] in reads[earlier] or
+                                   outputs[earlier] == outputs[later], range(later)))
+    return result
+
+
+def branches_read(basement: str, contents: [str]) -> set:
+    return set([basement] + list(map(branch_of, contents)))
+
+
+def run_graph(nodes: [], depends_on: {}, task: Callable[[object], bool], jobs: int) -> {}:
+    """Runs `task` for every node once all its dependencies are done, at most `jobs` tasks at once.
+
+    Returns map of node to its state: node which task failed (returned False or raised) cancels its dependents only,
+    independent nodes are still run. `nodes` have to be ordered so that dependencies precede dependents.
+    """
+    states = {}
+    waiting = list(nodes)
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(waiting) > 0 or len(running) > 0:
+            for node in list(waiting):
+                deps = depends_on.get(node, set())
+                if any(map(lambda d: states.get(d, None) in (FAILED, CANCELLED), deps)):
+                    states[node] = CANCELLED
+                    waiting.remove(node)
+                elif all(map(lambda d: states.get(d, None) == DONE, deps)):
+                    running[executor.submit(task, node)] = node
+                    waiting.remove(node)
+            if len(running) == 0:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                succeeded = future.exception() is None and future.result()
+                states[node] = DONE if succeeded else FAILED
+    return states
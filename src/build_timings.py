@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import json
+import os
+from git_refs import find_git_dir
+
+CACHE_DIR = 'git-tools'
+CACHE_FILE = 'build_timings.json'
+CACHE_VERSION = 1
+
+
+class BuildTimings:
+    """Durations of past branch builds stored under `.git/`, used to estimate upcoming builds.
+
+    Only the last build of each branch is kept together with number of commits it replayed.
+    """
+
+    def __init__(self, cwd: str) -> None:
+        self._path = os.path.join(find_git_dir(cwd), CACHE_DIR, CACHE_FILE)
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+            if data.get('version', None) == CACHE_VERSION:
+                self._entries = data.get('entries', {})
+        except (OSError, ValueError):
+            pass
+
+    def record(self, branch: str, seconds: float, commits: int) -> None:
+        self._entries[branch] = {'seconds': seconds, 'commits': commits}
+        self._dirty = True
+
+    def estimate(self, branch: str, commits: int) -> float:
+        """Returns expected seconds of building `commits` on `branch`, None until anything was built."""
+        entry = self._entries.get(branch, None)
+        if entry is not None and entry['commits'] > 0:
+            return entry['seconds'] * commits / entry['commits']
+        if entry is not None:
+            return entry['seconds']
+        # branch was never built, so average pace of other branches is used
+        built_commits = sum(map(lambda e: e['commits'], self._entries.values()))
+        if built_commits == 0:
+            return None
+        return sum(map(lambda e: e['seconds'], self._entries.values())) * commits / built_commits
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        tmp_path = self._path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, mode='w') as f:
+                json.dump({'version': CACHE_VERSION, 'entries': self._entries}, f)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            return
+        self._dirty = False
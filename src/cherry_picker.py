@@ -6,8 +6,12 @@
 # its contents used to cherry-pick revisions one-by-one
 import os
 import sys
-import subprocess
 from typing import Callable
+import git_client
+import git_refs
+import tracing
+from revision_resolver import RevisionResolver
+from tree_picker import TreeReplayer, ReplayConflict, author_env
 
 FALLBACK_BRANCH = 'master'
 CONTENT_COMMIT = 'commit_link'
@@ -28,7 +32,10 @@ class Picker:
                  verbose_ouput: bool = True,
                  dry_run: bool = False,
                  assume_assembled_properly: bool = False,
-                 fallback_branch: str = FALLBACK_BRANCH):
+                 fallback_branch: str = FALLBACK_BRANCH,
+                 in_memory: bool = False, # replay commits without checkouts, worktree is used only for conflicts
+                 resolver: RevisionResolver = None, # shared by pickers of one build to resolve revisions in batch
+                 scratch: bool = False): # cwd is scratch worktree: build on detached HEAD, move target by update-ref
         self.target_branch = target_branch
         self.basement_branch = basement_branch
 
@@ -40,50 +47,125 @@ class Picker:
         self.dry_run = dry_run
         self.assume_assembled_properly = assume_assembled_properly
         self.fallback_branch = fallback_branch
+        self.in_memory = in_memory
+        self.scratch = scratch
+        self.git = git_client.for_repo(cwd)
+        self.resolver = resolver if resolver is not None else RevisionResolver(cwd)
 
         self.verbose = verbose_ouput
 
     def run(self):
-        return self.cherry_pick()
+        with tracing.span('assemble', branch=self.target_branch):
+            return self.cherry_pick()
 
     def cherry_pick(self):
+        if self.in_memory and TreeReplayer(self.cwd).supported():
+            return self.cherry_pick_in_memory()
+        return self.cherry_pick_in_worktree(self.basement_branch, 0)
+
+    def cherry_pick_in_worktree(self, start_point: str, start: int):
         tmp_branch = 'temp/' + self.target_branch
-        self.run_cmd('git checkout ' + self.basement_branch, print_output=False)
-        self.run_cmd('git branch -D ' + tmp_branch, print_output=False, log_output=True, fallback=lambda: None)
-        print('Building at: ' + tmp_branch + ' (based on ' + self.basement_branch + ')')
+        if self.scratch:
+            # leftovers of interrupted build are dropped, scratch worktree has nothing of user
+            self.run_cmd(['checkout', '--detach', '--force', start_point], print_output=False)
+            print('Building at: ' + self.cwd + ' (based on ' + self.basement_branch + ')')
+        else:
+            self.run_cmd(['checkout', self.basement_branch], print_output=False)
+            self.run_cmd(['branch', '-D', tmp_branch], print_output=False, log_output=True, fallback=lambda: None)
+            print('Building at: ' + tmp_branch + ' (based on ' + self.basement_branch + ')')
         print('=========================================')
-        self.print('Branches to cherry-pick: ' + self.branches_to_cherry_pick.__str__())
-        self.run_cmd('git checkout -b ' + tmp_branch + ' ' + self.basement_branch)
-        cherry_picks = 0
+        self.print('Branches to cherry-pick: ' + self.branches_to_cherry_pick[start:].__str__())
+        if not self.scratch:
+            self.run_cmd(['checkout', '-b', tmp_branch, start_point])
+        cherry_picks = start
 
-        for i, line in enumerate(self.branches_to_cherry_pick):
-            if not self.cherry_pick_by_branch(line, tmp_branch):
+        for i, line in enumerate(self.branches_to_cherry_pick[start:], start):
+            if not self.cherry_pick_by_branch(line, tmp_branch, self.commit_messages[i]):
                 return False
 
             cherry_picks += 1
 
-            custom_message = self.commit_messages[i]
-            if custom_message and not self.amend(custom_message):
-                return False
-
         print('=========================================')
         print('Assembling complete. Take a look: ')
-        # os.system to show pretty output about commits
-        self.run_simple_cmd('git --no-pager log --oneline -' + str(cherry_picks + 1))
+        # attached to terminal to show pretty output about commits
+        self.git.call(['--no-pager', 'log', '--oneline', '-' + str(cherry_picks + 1)])
         print('=========================================')
+        if self.scratch:
+            if not self.can_commit_assemble():
+                self.print('Done!')
+                return False
+            return self.update_target(self.git.resolve(['HEAD'])[0])
         if self.can_commit_assemble():
-            self.run_cmd('git branch -D ' + self.target_branch, log_output=True, print_output=False, fallback=lambda: None)
-            self.run_cmd('git checkout -b ' + self.target_branch)
-            self.run_cmd('git branch -D ' + tmp_branch, print_output=False)
+            self.run_cmd(['branch', '-D', self.target_branch], log_output=True, print_output=False, fallback=lambda: None)
+            self.run_cmd(['checkout', '-b', self.target_branch])
+            self.run_cmd(['branch', '-D', tmp_branch], print_output=False)
+            self.resolver.invalidate(self.target_branch)
             self.log('Branch rebased: ' + self.target_branch + ' (on top of ' + self.basement_branch + ')')
             self.log('=========================================')
             print('Done! You are now on: ' + self.target_branch + ' (on top of ' + self.basement_branch + ')\n')
             return True
         else:
             print('Cleaning temporary branch: ' + tmp_branch)
-            self.run_cmd('git checkout ' + self.fallback_branch + ' && git branch -D ' + tmp_branch)
+            self.run_cmd(['checkout', self.fallback_branch])
+            self.run_cmd(['branch', '-D', tmp_branch])
+            self.print('Done!')
+            return False
+
+    def cherry_pick_in_memory(self):
+        """Replays commits with `merge-tree` and moves target branch once, conflicts continue in worktree."""
+        print('Building in memory: ' + self.target_branch + ' (based on ' + self.basement_branch + ')')
+        print('=========================================')
+        self.print('Branches to cherry-pick: ' + self.branches_to_cherry_pick.__str__())
+        head, replayed = self.replay_in_memory()
+        if replayed < len(self.branches_to_cherry_pick):
+            print('Failed to cherry-pick "' + self.branches_to_cherry_pick[replayed] +
+                  '" in memory, continuing in working tree')
+            return self.cherry_pick_in_worktree(head, replayed)
+
+        print('=========================================')
+        print('Assembling complete. Take a look: ')
+        self.git.call(['--no-pager', 'log', '--oneline', '-' + str(len(self.branches_to_cherry_pick) + 1), head])
+        print('=========================================')
+        if not self.can_commit_assemble():
             self.print('Done!')
             return False
+        return self.update_target(head)
+
+    def replay_in_memory(self) -> (str, int):
+        """Replays commits on top of basement until first conflict, returns resulting head and count of replayed ones."""
+        replayer = TreeReplayer(self.cwd)
+        head = self.resolver.rev_parse(self.basement_branch)
+        for i, line in enumerate(self.branches_to_cherry_pick):
+            print('Cherry-picking current ' + line)
+            try:
+                head = replayer.replay(head, self.resolver.rev_parse(line), self.commit_messages[i])
+            except ReplayConflict:
+                return head, i
+            if self.verbose:
+                self.git.call(['--no-pager', 'show', '-s', '--format=%B', head])
+        return head, len(self.branches_to_cherry_pick)
+
+    def update_target(self, head: str) -> bool:
+        """Moves target branch to assembled `head` without checking it out."""
+        reader = git_refs.RefReader(self.cwd)
+        previous = reader.branches().get(self.target_branch, None)
+        if reader.head_branch() == self.target_branch:
+            # checked out target is moved together with worktree, local changes are kept or reset refused
+            self.run_cmd(['reset', '--keep', head], print_output=False)
+        elif self.target_branch in reader.checked_out_branches():
+            print('Branch "' + self.target_branch + '" is checked out in another worktree, it is left at ' +
+                  (previous or '')[:7] + ', assembled commit is ' + head)
+            return False
+        else:
+            self.run_cmd(['update-ref', '-m', 'rebuild on ' + self.basement_branch, 'refs/heads/' + self.target_branch,
+                          head] + ([previous] if previous else []), print_output=False)
+        self.resolver.invalidate(self.target_branch)
+        if previous:
+            self.log('Branch ' + self.target_branch + ' was ' + previous)
+        self.log('Branch rebased: ' + self.target_branch + ' (on top of ' + self.basement_branch + ')')
+        self.log('=========================================')
+        print('Done! Branch updated: ' + self.target_branch + ' (on top of ' + self.basement_branch + ')\n')
+        return True
 
     def can_commit_assemble(self):
         if self.dry_run:
@@ -94,112 +176,105 @@ class Picker:
         return self.query_yes_no('Is branch assembled properly?') == 'yes'
 
     def up_to_date(self):
+        reason = self.staleness()
+        if reason is not None:
+            print('Going to rebuild "' + self.target_branch + '": ' + reason)
+        return reason is None
+
+    def staleness(self) -> str:
+        """Returns why target branch has to be rebuilt or None when it is up-to-date with basement."""
         cherry_picks_count = len(self.branches_to_cherry_pick)
         current_basement = self.target_branch + '~' + str(cherry_picks_count)
+        resolved = self.resolver.resolve([self.target_branch, current_basement, self.basement_branch])
 
-        commit_count = int(self.capture_output('git rev-list --count ' + self.target_branch, fallback=lambda: '-1'))
-        rebuild_msg = 'Going to rebuild "'+self.target_branch+'": '
+        if resolved[self.target_branch] is None: # branch not exists so it needs to be updated
+            return 'branch yet not exists'
 
-        if commit_count == -1: # branch not exists so it needs to be updated
-            print(rebuild_msg + 'branch yet not exists')
-            return False
+        if resolved[current_basement] is None:
+            return 'branch has less commits than expected'
 
-        if commit_count < cherry_picks_count:
-            print(rebuild_msg + 'branch has less commits than expected')
-            return False
+        if resolved[current_basement] != resolved[self.basement_branch]:
+            return 'basement of branch has changed (' + self.basement_branch + ')'
+        return None
 
-        current_hash = self.capture_output('git rev-parse ' + current_basement)
-        new_hash = self.capture_output('git rev-parse ' + self.basement_branch)
-
-        up_to_date_with_base = current_hash == new_hash
-        if not up_to_date_with_base:
-            print(rebuild_msg + 'basement of branch has changed ('+self.basement_branch+')')
-        return up_to_date_with_base
-
-    def capture_output(self, cmd: str, fallback=None) -> str:
-        try:
-            return subprocess.check_output(cmd, cwd=self.cwd, universal_newlines=True, shell=True)
-        except subprocess.CalledProcessError as e:
-            print(e.output)
-            if not fallback:
-                raise e
-            else:
-                return fallback()
-    pass
-
-    def cherry_pick_by_branch(self, branch: str, tmp_branch: str):
+    def cherry_pick_by_branch(self, branch: str, tmp_branch: str, message: str = None):
         print('Cherry-picking current ' + branch)
-        # printing commit message
-        self.run_cmd('git show -s --format=%B $(git rev-parse ' + branch + ')')
+        commit = self.resolver.rev_parse(branch)
+        headers, existing_message = TreeReplayer(self.cwd).read_commit(commit)
+        self.print(existing_message)
 
-        retcode = self.run_cmd('git cherry-pick $(git rev-parse ' + branch + ')',
+        if message and message.strip() == existing_message.strip():
+            print('Skipping amend cause message is up-to-date')
+        elif message:
+            return self.cherry_pick_with_message(commit, headers, existing_message, message, tmp_branch)
+
+        retcode = self.run_cmd(['cherry-pick', commit],
                      fallback=lambda: self.try_continue_cherry_pick(tmp_branch),
                      print_output=self.verbose)
         return retcode == 0
 
-    def amend(self, message: str) -> bool:
-        existing_message = self.capture_output('git show --no-patch --format=%B HEAD~0').strip()
+    def cherry_pick_with_message(self, commit: str, headers: {}, existing_message: str, message: str,
+                                 tmp_branch: str) -> bool:
+        """Applies commit without committing and commits it once with custom message and original author."""
         message = message.strip()
-        message_up_to_date : bool = existing_message == message
-            
-        if message_up_to_date:
-            print('Skipping amend cause message is up-to-date')
-            return True
-        
-        print('Overwriting existing message "'+existing_message+'"')
+        print('Overwriting existing message "'+existing_message.strip()+'"')
         print('With own message: "'+message+'"')
 
-        tmp_commit_file = '/tmp/builder_commit_message'
-        with open(tmp_commit_file, "w") as text_file:
-            text_file.write(message)
-        retcode = self.run_cmd('git commit --amend --file='+tmp_commit_file)
-        return retcode == 0
-
-    def run_cmd(self, command: str, fallback: Callable[[], None] = None, log_output: bool = False, print_output: bool = True):
-        with subprocess.Popen(command,
-                              shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              universal_newlines=True,
-                              cwd=self.cwd) as p:
-            result = p.wait()
-            output = p.stdout.readlines()
-            error = p.stderr.readlines()
-
-            if print_output or result != 0:
-                for line in output:
-                    self.print(line)
+        retcode = self.run_cmd(['cherry-pick', '--no-commit', commit],
+                               fallback=lambda: self.try_continue_cherry_pick(tmp_branch, no_commit=True),
+                               print_output=self.verbose)
+        if retcode != 0:
+            return False
 
+        result = self.git.run(['commit', '--quiet', '--file=-'], input=message + '\n', env=author_env(headers),
+                              check=False)
+        if result.returncode != 0:
+            self.print(result.stdout)
+            self.print(result.stderr)
+        return result.returncode == 0
+
+    def run_cmd(self, args: [str], fallback: Callable[[], None] = None, log_output: bool = False, print_output: bool = True):
+        def on_output(line: str):
+            if print_output:
+                self.print(line)
             if log_output:
-                for line in output:
-                    self.log(line)
-
-        if result != 0:
-            if fallback is None:
-                raise Exception('shell command failed: ' + command + '\n with: ' + error.__str__())
-            else:
-                for line in error:
-                    self.print(line)
+                self.log(line)
 
-                return fallback()
+        result = self.git.stream(args, on_stdout=on_output, check=fallback is None)
+        if result.returncode != 0:
+            if not print_output:
+                for line in result.stdout.lines():
+                    self.print(line)
+            for line in result.stderr.lines():
+                self.print(line)
+            return fallback()
         else:
-            return result
-
-    def try_continue_cherry_pick(self, tmp_branch: str):
-        abort_cherry_pick = 'git cherry-pick --abort && git checkout ' + FALLBACK_BRANCH + ' && git branch -D ' + tmp_branch
+            return result.returncode
+
+    def try_continue_cherry_pick(self, tmp_branch: str, no_commit: bool = False):
+        # `cherry-pick --no-commit` leaves no sequencer state, so it is rolled back by reset
+        abort = ['reset', '--merge'] if no_commit else ['cherry-pick', '--abort']
+        if no_commit:
+            question = 'Cherry pick failed! Resolve conflicts as usual and stage them by `git add`, ' \
+                       'commit with configured message will be created. Ready?'
+        else:
+            question = 'Cherry pick failed! Resolve conflicts as usual and finish cherry pick by `git cherry-pick --continue`. Ready?'
+        if self.scratch:
+            question = question.replace('Resolve conflicts', 'Resolve conflicts at ' + self.cwd)
 
-        if self.query_yes_no(
-                'Cherry pick failed! Resolve conflicts as usual and finish cherry pick by `git cherry-pick --continue`. Ready?') == 'yes':
+        if self.query_yes_no(question) == 'yes':
             return 0
         else:
             print('Rolling back cherry-pick process!')
-            self.run_cmd(abort_cherry_pick)
+            if self.scratch:
+                self.run_cmd(abort)
+                print('Done! Branch is left untouched: ' + self.target_branch)
+                return -1
+            for args in (abort, ['checkout', FALLBACK_BRANCH], ['branch', '-D', tmp_branch]):
+                self.run_cmd(args)
             print('Done! You are now on: ' + FALLBACK_BRANCH)
             return -1
 
-    def run_simple_cmd(self, cmd: str):
-        os.system('cd ' + self.cwd + ' && ' + cmd)
-
     def query_yes_no(self, question: str, default: str='yes') -> str:
         return query_yes_no(question, self.input_provider, default)
 
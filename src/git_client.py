@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+import atexit
+import contextlib
+import os
+import subprocess
+import threading
+from collections import deque
+import git_refs
+import tracing
+
+# requests written to cat-file before reading responses back, small enough to never fill pipe buffers
+BATCH_CHUNK = 128
+BATCH_CHECK_FORMAT = '--batch-check=%(objectname) %(objecttype)'
+UNRESOLVED = ('missing', 'ambiguous')
+# output of streamed commands kept for error reports
+DEFAULT_RETAINED_BYTES = 64 * 1024
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class GitError(Exception):
+    """Failed git command with its argv, exit code and captured output."""
+
+    def __init__(self, command: [str], returncode: int, stdout: str = '', stderr: str = '') -> None:
+        super().__init__('git command failed: ' + ' '.join(command) + '\n with: ' + (stderr or '').strip())
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class OutputTail:
+    """Ring buffer of output lines bounded by total size, oldest lines are dropped first."""
+
+    def __init__(self, max_bytes: int = DEFAULT_RETAINED_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._lines = deque()
+        self._size = 0
+
+    def append(self, line: str) -> None:
+        self._lines.append(line)
+        self._size += len(line)
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            self._size -= len(self._lines.popleft())
+            self.dropped += 1
+
+    def lines(self) -> [str]:
+        return list(self._lines)
+
+    def __str__(self) -> str:
+        skipped = '...' + str(self.dropped) + ' lines skipped...\n' if self.dropped > 0 else ''
+        return skipped + ''.join(self._lines)
+
+
+class StreamResult:
+    def __init__(self, returncode: int, stdout: OutputTail, stderr: OutputTail) -> None:
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class Git:
+    """Single entry point to git of one repository.
+
+    Commands are spawned as argv lists (no shell) and fail with `GitError`. Object and revision lookups
+    are served by long-lived `git cat-file --batch`/`--batch-check` coprocesses, so they cost a pipe
+    round trip instead of a process spawn.
+    """
+
+    def __init__(self, cwd: str) -> None:
+        self.cwd = cwd
+        self._batch = None
+        self._batch_check = None
+        self._lock = threading.Lock()
+
+    def run(self, args: [str], input=None, env: {} = None, check: bool = True,
+            text: bool = True) -> subprocess.CompletedProcess:
+        """Runs `git <args>` capturing stdout and stderr (as bytes if `text` is False)."""
+        command = ['git'] + args
+        with _span(args) as span:
+            result = subprocess.run(command, input=input, env=env, cwd=self.cwd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, universal_newlines=text)
+            span['exit_code'] = result.returncode
+        if check and result.returncode != 0:
+            raise GitError(command, result.returncode, result.stdout, result.stderr)
+        return result
+
+    def output(self, args: [str], input=None, env: {} = None) -> str:
+        return self.run(args, input=input, env=env).stdout
+
+    def lines(self, args: [str]) -> [str]:
+        return self.output(args).splitlines()
+
+    def succeeds(self, args: [str]) -> bool:
+        return self.run(args, check=False).returncode == 0
+
+    def stream(self, args: [str], on_stdout=None, on_stderr=None, env: {} = None, check: bool = True,
+               retain: int = DEFAULT_RETAINED_BYTES) -> StreamResult:
+        """Runs `git <args>` passing output lines to callbacks as they arrive.
+
+        Both streams are read concurrently, so chatty commands never block on full pipe, and only last
+        `retain` bytes of each stream are kept for result (and error report).
+        """
+        command = ['git'] + args
+        stdout, stderr = OutputTail(retain), OutputTail(retain)
+        callback_lock = threading.Lock()  # callbacks are never called concurrently
+        with _span(args) as span, subprocess.Popen(command, cwd=self.cwd, env=env, stdout=subprocess.PIPE,
+                                                   stderr=subprocess.PIPE, universal_newlines=True,
+                                                   errors='replace') as process:
+            stderr_reader = threading.Thread(target=_pump, args=(process.stderr, stderr, on_stderr, callback_lock),
+                                             daemon=True)
+            stderr_reader.start()
+            _pump(process.stdout, stdout, on_stdout, callback_lock)
+            stderr_reader.join()
+            returncode = process.wait()
+            span['exit_code'] = returncode
+        if check and returncode != 0:
+            raise GitError(command, returncode, str(stdout), str(stderr))
+        return StreamResult(returncode, stdout, stderr)
+
+    def call(self, args: [str]) -> int:
+        """Runs `git <args>` attached to terminal (for colored logs and status), returns exit code."""
+        with _span(args) as span:
+            span['exit_code'] = subprocess.call(['git'] + args, cwd=self.cwd)
+        return span['exit_code']
+
+    def resolve(self, revisions: [str]) -> [str]:
+        """Resolves revisions (like `branch~2^{commit}`) to object names, None for missing ones."""
+        results = []
+        with self._lock, _span(['cat-file', BATCH_CHECK_FORMAT], revisions=len(revisions)):
+            if self._batch_check is None or self._batch_check.poll() is not None:
+                self._batch_check = self._start([BATCH_CHECK_FORMAT])
+            for start in range(0, len(revisions), BATCH_CHUNK):
+                chunk = revisions[start:start + BATCH_CHUNK]
+                self._request(self._batch_check, chunk)
+                for _ in chunk:
+                    line = self._batch_check.stdout.readline().decode().rstrip('\n')
+                    results.append(None if line.rsplit(' ', 1)[-1] in UNRESOLVED else line.split(' ', 1)[0])
+        return results
+
+    def read_objects(self, revisions: [str]) -> [(str, str, bytes)]:
+        """Reads `(name, type, contents)` of objects, None for missing ones."""
+        results = []
+        with self._lock, _span(['cat-file', '--batch'], revisions=len(revisions)):
+            if self._batch is None or self._batch.poll() is not None:
+                self._batch = self._start(['--batch'])
+            for start in range(0, len(revisions), BATCH_CHUNK):
+                chunk = revisions[start:start + BATCH_CHUNK]
+                self._request(self._batch, chunk)
+                for _ in chunk:
+                    header = self._batch.stdout.readline().decode().rstrip('\n').split(' ')
+                    if len(header) != 3:  # "<rev> missing" or "<rev> ambiguous"
+                        results.append(None)
+                        continue
+                    name, object_type, size = header
+                    contents = self._batch.stdout.read(int(size) + 1)[:-1]  # contents are followed by newline
+                    results.append((name, object_type, contents))
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            for process in (self._batch, self._batch_check):
+                if process is not None:
+                    process.stdin.close()
+                    process.wait()
+                    process.stdout.close()
+            self._batch = None
+            self._batch_check = None
+
+    def _start(self, options: [str]) -> subprocess.Popen:
+        # absolute git dir keeps coprocess valid even if checkout directory is deleted and created again,
+        # objects are content addressed and refs are re-read on every lookup
+        try:
+            git_dir = ['--git-dir=' + git_refs.find_git_dirs(self.cwd)[0]]
+        except Exception:
+            git_dir = []
+        return subprocess.Popen(['git'] + git_dir + ['cat-file'] + options, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=self.cwd)
+
+    def _request(self, process: subprocess.Popen, revisions: [str]) -> None:
+        if any(map(lambda r: '\n' in r, revisions)):
+            raise ValueError('Revision with line break: ' + repr(revisions))
+        process.stdin.write(''.join(map(lambda r: r + '\n', revisions)).encode())
+        process.stdin.flush()
+
+
+def _span(args: [str], **extra):
+    """Span of git command named after its operation (`git checkout`), no-op unless tracing is started."""
+    if not tracing.enabled():
+        return contextlib.nullcontext({})
+    operation = next(filter(lambda a: not a.startswith('-'), args), args[0] if args else '')
+    return tracing.span('git ' + operation, command=' '.join(args), **extra)
+
+
+def _pump(stream, tail: OutputTail, callback, callback_lock: threading.Lock) -> None:
+    for line in stream:
+        tail.append(line)
+        if callback is not None:
+            with callback_lock:
+                callback(line)
+
+
+def for_repo(cwd: str) -> Git:
+    """Returns `Git` shared by all tools working with `cwd` in current process.
+
+    Clients are keyed by pid as well, so forked workers never write to coprocesses of their parent.
+    """
+    key = (os.getpid(), os.path.abspath(cwd))
+    with _clients_lock:
+        client = _clients.get(key, None)
+        if client is None:
+            client = Git(cwd)
+            _clients[key] = client
+        return client
+
+
+@atexit.register
+def close_all() -> None:
+    with _clients_lock:
+        for (pid, _), client in list(_clients.items()):
+            if pid == os.getpid():
+                client.close()
+        _clients.clear()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import mmap
+import os
+import git_client
+
+LOCAL_PREFIX = 'refs/heads/'
+REMOTE_PREFIX = 'refs/remotes/'
+SYMBOLIC_REF = 'ref: '
+
+
+def find_git_dirs(cwd: str) -> (str, str):
+    """Returns `(git_dir, common_dir)` of repository containing `cwd`.
+
+    `git_dir` keeps per-worktree files (HEAD), `common_dir` is shared by all worktrees (refs, packed-refs, config).
+    Both are the same `<repo>/.git` for regular checkouts.
+    """
+    candidate = os.path.abspath(cwd)
+    while not os.path.exists(os.path.join(candidate, '.git')):
+        parent = os.path.dirname(candidate)
+        if parent == candidate:
+            raise Exception('Not a git repository: ' + cwd)
+        candidate = parent
+
+    git_dir = os.path.join(candidate, '.git')
+    if os.path.isfile(git_dir):  # worktree or submodule: "gitdir: <path>"
+        with open(git_dir) as f:
+            pointer = f.read().strip()
+        git_dir = os.path.join(candidate, pointer[len('gitdir:'):].strip())
+    git_dir = os.path.normpath(git_dir)
+
+    common_dir = git_dir
+    commondir_file = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir_file):
+        with open(commondir_file) as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    return git_dir, common_dir
+
+
+def find_git_dir(cwd: str) -> str:
+    """Finds directory shared by all worktrees of repository containing `cwd` (usually `<repo>/.git`)."""
+    return find_git_dirs(cwd)[1]
+
+
+def short_name(refname: str) -> str:
+    for prefix in (LOCAL_PREFIX, REMOTE_PREFIX):
+        if refname.startswith(prefix):
+            return refname[len(prefix):]
+    return refname
+
+
+class UnsupportedLayout(Exception):
+    pass
+
+
+class RefReader:
+    """Reads HEAD and refs straight from `.git` files: loose refs override memory-mapped `packed-refs`.
+
+    Falls back to spawning git for layouts it does not understand (reftable, broken or missing files).
+    """
+
+    def __init__(self, cwd: str) -> None:
+        self.cwd = cwd
+        try:
+            self.git_dir, self.common_dir = find_git_dirs(cwd)
+            self._native = os.path.isfile(os.path.join(self.git_dir, 'HEAD')) and \
+                not os.path.exists(os.path.join(self.common_dir, 'reftable'))
+        except Exception:
+            self._native = False
+
+    def head_branch(self) -> str:
+        """Returns short name of checked out branch or None when HEAD is detached."""
+        if self._native:
+            try:
+                return self._read_head_branch()
+            except (OSError, UnsupportedLayout):
+                pass
+        result = git_client.for_repo(self.cwd).run(['symbolic-ref', '-q', 'HEAD'], check=False)
+        if result.returncode != 0:
+            return None
+        return short_name(result.stdout.strip())
+
+    def refs(self, prefix: str = LOCAL_PREFIX) -> {}:
+        """Returns map of full ref name to hash for all refs under `prefix` ordered by ref name."""
+        if not prefix.endswith('/'):
+            prefix += '/'  # `refs/heads` must neither match `refs/headsX` nor leave leading slash in names
+        if self._native:
+            try:
+                return self._read_refs(prefix)
+            except (OSError, UnsupportedLayout):
+                pass
+        lines = git_client.for_repo(self.cwd).lines(['for-each-ref', '--format=%(refname)%00%(objectname)', prefix])
+        return dict(map(lambda line: tuple(line.split('\0', 1)), lines))
+
+    def checked_out_branches(self) -> set:
+        """Returns branches checked out in any worktree of repository, such branches should never be deleted."""
+        if self._native:
+            try:
+                heads = [os.path.join(self.common_dir, 'HEAD')]
+                worktrees = os.path.join(self.common_dir, 'worktrees')
+                if os.path.isdir(worktrees):
+                    heads.extend(map(lambda w: os.path.join(worktrees, w, 'HEAD'), os.listdir(worktrees)))
+                branches = set()
+                for head in heads:
+                    with open(head) as f:
+                        value = f.read().strip()
+                    if value.startswith(SYMBOLIC_REF):
+                        branches.add(short_name(value[len(SYMBOLIC_REF):]))
+                return branches
+            except OSError:
+                pass
+        lines = git_client.for_repo(self.cwd).lines(['worktree', 'list', '--porcelain'])
+        return set(map(lambda line: short_name(line[len('branch '):]),
+                       filter(lambda line: line.startswith('branch '), lines)))
+
+    def branches(self, prefix: str = LOCAL_PREFIX) -> {}:
+        """Same as `refs` but keyed by short branch names (`feature` or `origin/feature`)."""
+        return dict(map(lambda e: (short_name(e[0]), e[1]), self.refs(prefix).items()))
+
+    def _read_head_branch(self) -> str:
+        with open(os.path.join(self.git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith(SYMBOLIC_REF):
+            if len(head) < 40:
+                raise UnsupportedLayout(head)
+            return None
+        return short_name(head[len(SYMBOLIC_REF):])
+
+    def _read_refs(self, prefix: str) -> {}:
+        refs = self._read_packed_refs(prefix)
+        loose_root = os.path.join(self.common_dir, prefix)
+        for root, _, files in os.walk(loose_root):
+            for file in files:
+                if file.endswith('.lock'):
+                    continue
+                path = os.path.join(root, file)
+                with open(path) as f:
+                    value = f.read().strip()
+                if value.startswith(SYMBOLIC_REF):  # like refs/remotes/origin/HEAD
+                    continue
+                if len(value) < 40:
+                    raise UnsupportedLayout(path)
+                refname = prefix + os.path.relpath(path, loose_root).replace(os.sep, '/')
+                refs[refname] = value
+        return dict(sorted(refs.items()))
+
+    def _read_packed_refs(self, prefix: str) -> {}:
+        refs = {}
+        path = os.path.join(self.common_dir, 'packed-refs')
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return refs
+
+        encoded_prefix = prefix.encode()
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as packed:
+            header_end = packed.find(b'\n') if packed[:1] == b'#' else -1
+            is_sorted = b' sorted' in packed[:header_end + 1]
+            size = len(packed)
+            # every ref line is "<hash> <refname>", so first ref under prefix can be found without parsing
+            position = packed.find(b' ' + encoded_prefix)
+            if position == -1:
+                return refs
+            position = packed.rfind(b'\n', 0, position) + 1
+            while position < size:
+                line_end = packed.find(b'\n', position)
+                if line_end == -1:
+                    line_end = size
+                line = packed[position:line_end]
+                position = line_end + 1
+                if line.startswith(b'^'):  # peeled hash of annotated tag
+                    continue
+                sha, _, refname = line.partition(b' ')
+                if refname.startswith(encoded_prefix):
+                    refs[refname.decode()] = sha.decode()
+                elif is_sorted:
+                    break
+        return refs
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import json
+import os
+from collections import OrderedDict
+from git_refs import find_git_dir
+
+CACHE_DIR = 'git-tools'
+CACHE_FILE = 'branch_metadata.json'
+CACHE_VERSION = 1
+DEFAULT_CAPACITY = 10000
+
+
+class MetadataCache:
+    """Persistent LRU map of commit hash to its subject, author and date stored under `.git/`.
+
+    Commits are immutable so entries never go stale, they are only evicted once cache exceeds capacity.
+    """
+
+    def __init__(self, cwd: str, capacity: int = DEFAULT_CAPACITY) -> None:
+        self.capacity = capacity
+        self._path = os.path.join(find_git_dir(cwd), CACHE_DIR, CACHE_FILE)
+        self._entries = OrderedDict()
+        self._dirty = False
+        self._load()
+
+    def get(self, sha: str) -> {}:
+        entry = self._entries.get(sha, None)
+        if entry is not None and next(reversed(self._entries)) != sha:
+            self._entries.move_to_end(sha)
+            self._dirty = True  # recency has to survive runs without misses too
+        return entry
+
+    def put(self, sha: str, subject: str, author: str, date: int) -> None:
+        self._entries[sha] = {'subject': subject, 'author': author, 'date': date}
+        self._entries.move_to_end(sha)
+        self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+        entries = list(self._entries.items())  # snapshot, loader thread may still add entries
+        tmp_path = self._path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, mode='w') as f:
+                json.dump({
+                    'version': CACHE_VERSION,
+                    # oldest first, so LRU order survives reload
+                    'entries': [[sha, e['subject'], e['author'], e['date']] for sha, e in entries],
+                }, f)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            return  # cache is best effort, next run will resolve these commits again
+        self._dirty = False
+
+    def _load(self) -> None:
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version', None) != CACHE_VERSION:
+            return
+        for sha, subject, author, date in data.get('entries', []):
+            self._entries[sha] = {'subject': subject, 'author': author, 'date': date}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, sha: str) -> bool:
+        return sha in self._entries
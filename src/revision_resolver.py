@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import re
+import threading
+import git_client
+
+# revision suffixes like `~2`, `^`, `@{1}` or `:path` follow branch name
+REVISION_SUFFIX = re.compile(r'[~^@:]')
+
+
+def branch_of(revision: str) -> str:
+    """Returns branch (or other ref) part of revision: `feature` for `feature~2`."""
+    match = REVISION_SUFFIX.search(revision)
+    return revision[:match.start()] if match else revision
+
+
+class RevisionResolver:
+    """Resolves revisions to commit hashes in batches through shared `git cat-file --batch-check` coprocess.
+
+    Resolved hashes are kept until branch is invalidated (after it was rebuilt), so every revision
+    costs one line of batch request instead of separate `git rev-parse`.
+    """
+
+    def __init__(self, cwd: str) -> None:
+        self.cwd = cwd
+        self._resolved = {}
+        self._lock = threading.Lock()  # shared by pickers building in parallel
+
+    def resolve(self, revisions: [str]) -> {}:
+        """Returns map of revision to commit hash (or None when revision is missing)."""
+        with self._lock:
+            missing = list(dict.fromkeys(filter(lambda r: r not in self._resolved, revisions)))
+            if len(missing) > 0:
+                shas = git_client.for_repo(self.cwd).resolve(list(map(lambda r: r + '^{commit}', missing)))
+                self._resolved.update(zip(missing, shas))
+            return dict(map(lambda r: (r, self._resolved[r]), revisions))
+
+    def get(self, revision: str) -> str:
+        return self.resolve([revision])[revision]
+
+    def rev_parse(self, revision: str) -> str:
+        """Same as `get` but fails for missing revisions like `git rev-parse --verify` does."""
+        sha = self.get(revision)
+        if sha is None:
+            raise Exception('Failed to resolve revision "' + revision + '"')
+        return sha
+
+    def invalidate(self, branch: str) -> None:
+        """Forgets all revisions based on `branch`, they are resolved again on next request."""
+        with self._lock:
+            for revision in list(filter(lambda r: branch_of(r) == branch, self._resolved)):
+                del self._resolved[revision]
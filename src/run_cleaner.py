@@ -1,29 +1,73 @@
 #!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import fnmatch
+import io
+import json
 import os
-import subprocess
 import sys
 import branch_filter
+import branch_metadata
+import git_client
+import git_refs
+from metadata_cache import MetadataCache
+from squash_detector import SquashDetector
+from workflow_updater import load_yaml
+
+LOG_FILE = os.path.dirname(__file__) + '/delete.log'
+GONE = '[gone]'
+PUSH_DELETED = '-'  # flag of deleted ref in `git push --porcelain` output
+# pushes are split so that command line stays far below ARG_MAX (and Windows 32K limit)
+MAX_PUSH_ARGS_LENGTH = 30000
+
 
 class Cleaner:
 
     def __init__(self,
-                 log_file=os.path.dirname(__file__) + '/delete.log',
+                 log_file=LOG_FILE,
                  cwd=os.path.abspath(''),
                  upstream='origin/master',
                  suppress_prompt=False,
                  input_provider=lambda : input().lower(),
+                 detect_squashed=False, # also look for branches merged by squash or rebase
+                 remotes=None, # prune merged branches of these remotes instead of local ones
                  ):
         self.log_file = log_file
         self.cwd = find_dot_git(cwd)
-        self.upstream = upstream
+        self.git = git_client.for_repo(self.cwd)
+        # several upstreams (or patterns like 'origin/release/*') may be given as list
+        self.upstreams = [upstream] if isinstance(upstream, str) else list(upstream)
+        self.upstream = ','.join(self.upstreams)
         self.suppress_prompt = suppress_prompt
         self.input_provider = input_provider
+        self.detect_squashed = detect_squashed
+        self.remotes = remotes or []
 
     def run(self):
-        self.current_branch = self.capture_output('git rev-parse --abbrev-ref HEAD').splitlines()[0]
-        self.all_branches = self.capture_output('git branch').replace('* ', '').replace(' ', '').splitlines()
+        if self.remotes:
+            return self.run_remote()
+        self.detect_merged_branches()
+        if not self.suppress_prompt:
+            bfilter = branch_filter.BranchFilter(cwd=self.cwd, input_provider=self.input_provider,
+                                                 known_branches=self.known_branches)
+            bfilter.extend_selected(self.merged_branches)
+            self.merged_branches = bfilter.find_many()
+        return self.delete_selected(dict(map(lambda b: (b.name, b.sha), self.known_branches)))
+
+    def detect_merged_branches(self) -> [str]:
+        self.current_branch = git_refs.RefReader(self.cwd).head_branch() or 'HEAD'
+        # uncached messages are loaded by BranchFilter in background, detection needs only names
+        self.known_branches = branch_metadata.list_branches(self.cwd, cache=MetadataCache(self.cwd))
+        self.all_branches = list(map(lambda b: b.name, self.known_branches))
         if self._upstream_exists():
-            self.merged_branches = list(filter(self.is_merged, self.all_branches))
+            # upstreams are trivially merged into themselves but they are not subject of cleanup
+            merged = self.find_merged_branches().difference(self.upstreams)
+            if self.detect_squashed:
+                merged.update(self.find_squashed_branches(
+                    dict(map(lambda b: (b.name, b.sha), self.known_branches)), merged))
+            self.merged_branches = list(filter(lambda b: b in merged, self.all_branches))
 
             if len(self.merged_branches) == 0:
                 print('There are no local branches that were merged to upstream('+self.upstream+')!')
@@ -31,83 +75,304 @@ class Cleaner:
                 print('Found '+str(len(self.merged_branches))+' branches that were merged to upstream('+self.upstream+')!')
         else:
             self.merged_branches = []
+        return self.merged_branches
+
+    def run_remote(self):
+        """Deletes remote branches merged to upstreams, then local branches which upstreams are gone."""
+        self.current_branch = git_refs.RefReader(self.cwd).head_branch() or 'HEAD'
+        upstream_exists = self._upstream_exists()
+        merged_remote = self.find_merged_remote_branches() if upstream_exists else []
+        if len(merged_remote) == 0:
+            print('There are no remote branches that were merged to upstream('+self.upstream+')!')
+        else:
+            print('Found '+str(len(merged_remote))+' remote branches that were merged to upstream('+self.upstream+')!')
+            if not self.suppress_prompt:
+                bfilter = branch_filter.BranchFilter(cwd=self.cwd, input_provider=self.input_provider,
+                                                     source=branch_filter.SOURCE_REMOTE)
+                bfilter.extend_selected(merged_remote)
+                merged_remote = bfilter.find_many()
+            print('\nDeleting remote branches:')
+            self.delete_remote_branches(merged_remote)
 
-        bfilter = branch_filter.BranchFilter(cwd=self.cwd, input_provider=self.input_provider)
-        bfilter.extend_selected(self.merged_branches)
-        self.merged_branches = bfilter.find_many()
+        if not upstream_exists:
+            return {}  # without upstream nothing proves that gone branches were merged
+        # pushed deletes have just removed tracking refs, so their local branches are found here as well
+        gone = self.find_gone_branches()
+        if len(gone) == 0:
+            return {}
+        merged = self.find_merged_branches().intersection(gone)
+        if self.detect_squashed:
+            merged.update(self.find_squashed_branches(gone, merged))
+        self.merged_branches = list(filter(lambda b: b in merged, gone))
+        print('Found '+str(len(gone))+' local branches which upstream is gone, '+str(len(self.merged_branches))+
+              ' of them merged to upstream('+self.upstream+')!')
+        unmerged = list(filter(lambda b: b not in merged, gone))
+        if len(unmerged) > 0:
+            print('Not merged, kept unless selected: ' + ', '.join(unmerged))
+        if not self.suppress_prompt:
+            bfilter = branch_filter.BranchFilter(cwd=self.cwd, input_provider=self.input_provider)
+            bfilter.extend_selected(self.merged_branches)
+            self.merged_branches = bfilter.find_many()
+        return self.delete_selected(gone)
 
+    def delete_selected(self, tips: {}) -> {}:
+        """Deletes selected `self.merged_branches` which are not checked out, `tips` are their tips at detection."""
         print('\nDeleting:')
-        for merged in self.merged_branches:
-            if merged != self.current_branch:
-                self.git_branch_minus_D(merged)
+        checked_out = git_refs.RefReader(self.cwd).checked_out_branches()
+        checked_out.add(self.current_branch)
+        selected = filter(lambda b: b in tips and b not in checked_out, self.merged_branches)
+        return self.delete_branches(dict(map(lambda b: (b, tips[b]), selected)))
 
-    def _upstream_exists(self):
-        got_exception = self.run_cmd(
-            'git rev-parse --abbrev-ref '+self.upstream,
-            fallback=lambda: None
-        ) != 0
+    def find_merged_remote_branches(self) -> [str]:
+        """Returns branches of `self.remotes` reachable from any of upstreams with single ref walk.
 
-        if got_exception:
-            print('Failed to access upsteam branch "'+self.upstream+
-            '" with merged-changes! Please specify upstream as second argument!')
+        Remote counterparts of upstreams are never returned: branches named like an upstream on any of remotes,
+        branches at the same commit as an upstream and branches pointed by `<remote>/HEAD`.
+        """
+        args = ['for-each-ref', '--format=%(refname:short)%00%(objectname)%00%(symref)']
+        args.extend(map(lambda u: '--merged=' + u, self.upstreams))
+        args.extend(map(lambda r: git_refs.REMOTE_PREFIX + r + '/', self.remotes))
+        upstream_tips = set(self.git.resolve(list(map(lambda u: u + '^{commit}', self.upstreams))))
+        protected = set(self.upstreams)
+        for upstream in self.upstreams:
+            remote = next(filter(lambda r: upstream.startswith(r + '/'), self.remotes), None)
+            name = upstream[len(remote) + 1:] if remote else upstream
+            protected.update(map(lambda r: r + '/' + name, self.remotes))
+        merged = []
+        for line in self.git.lines(args):
+            branch, sha, symref = line.split('\0', 2)
+            if symref:
+                protected.add(git_refs.short_name(symref))
+            elif sha not in upstream_tips:
+                merged.append(branch)
+        return list(filter(lambda b: b not in protected, merged))
 
-        return not got_exception
+    def find_gone_branches(self) -> {}:
+        """Returns local branches which upstream was deleted mapped to their tips, with single `for-each-ref` call."""
+        output = self.git.lines(['for-each-ref', '--format=%(refname:short)%00%(objectname)%00%(upstream:track)',
+                                 git_refs.LOCAL_PREFIX])
+        lines = map(lambda line: line.split('\0', 2), output)
+        return dict(map(lambda e: (e[0], e[1]), filter(lambda e: e[2] == GONE, lines)))
 
-    def is_merged(self, branch):
-        cmd = 'git log -n 1 --oneline '+branch+' --not '+self.upstream
-        try:
-            return self.capture_output(cmd) == ''
-        except Exception as exc:
-            print('Unexpected exception during command: ' + cmd)
-            raise Exception(exc)
-        
-
-    def capture_output(self, cmd):
-        return subprocess.check_output(cmd, cwd=self.cwd, universal_newlines=True, shell=True)
-
-    def git_branch_minus_D(self, _branch):
-        self.run_cmd('git branch -D '+_branch, log_output=True)
-        pass
-
-    def run_cmd(self, command, fallback=None, log_output=False, print_output=True):
-        with subprocess.Popen(command,
-                              shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              universal_newlines=True,
-                              cwd=self.cwd) as p:
-            result = p.wait()
-            output = p.stdout.readlines()
-            error = p.stderr.readlines()
-
-            if print_output or result != 0:
-                for line in output:
-                    print(line)
-
-
-            if log_output:
-                with open(self.log_file, mode='a') as f:
-                    for line in output:
-                        print(line, file=f)
-
-        if result != 0:
-            if fallback is None:
-                raise Exception('shell command failed: ' + command + '\n with: ' + error.__str__())
+    def delete_remote_branches(self, branches: [str]) -> [str]:
+        """Deletes remote branches (like `origin/feature`) with one `git push --delete` per remote and chunk.
+
+        Refs rejected by remote (or of failed push) are reported and kept, returns only really deleted branches.
+        """
+        by_remote = {}
+        for branch in branches:
+            remote = next(filter(lambda r: branch.startswith(r + '/'), self.remotes), None)
+            if remote is None:
+                raise Exception('Branch "' + branch + '" does not belong to any of remotes: ' + ','.join(self.remotes))
+            by_remote.setdefault(remote, []).append(git_refs.LOCAL_PREFIX + branch[len(remote) + 1:])
+
+        deleted = []
+        rejected = []
+        for remote, refs in by_remote.items():
+            for chunk in chunk_args(refs, MAX_PUSH_ARGS_LENGTH):
+                # push is not atomic, remote may delete some refs and reject others
+                result = self.git.run(['push', '--porcelain', '--delete', remote] + chunk, check=False)
+                statuses = push_statuses(result.stdout)
+                failure = (result.stderr or '').strip().splitlines()[-1:] or ['push failed']
+                for ref in chunk:
+                    branch = remote + '/' + git_refs.short_name(ref)
+                    flag, summary = statuses.get(ref, ('!', failure[0]))
+                    if flag == PUSH_DELETED:
+                        print('Deleted remote branch ' + branch + '.')
+                        deleted.append(branch)
+                    else:
+                        print('Failed to delete remote branch ' + branch + ': ' + summary)
+                        rejected.append(branch)
+        if len(rejected) > 0:
+            print('Deleted ' + str(len(deleted)) + ' remote branches, ' + str(len(rejected)) + ' were kept: ' +
+                  ', '.join(rejected))
+        return deleted
+
+    def _upstream_exists(self):
+        self.upstreams = self._expand_upstreams(self.upstreams)
+        resolved = branch_metadata.resolve_revisions(self.cwd, self.upstreams)
+        missing = list(filter(lambda u: resolved[u] is None, self.upstreams))
+        for upstream in missing:
+            print('Failed to access upsteam branch "'+upstream+
+            '" with merged-changes! Please specify upstream as second argument!')
+        self.upstreams = list(filter(lambda u: resolved[u] is not None, self.upstreams))
+        if len(self.upstreams) == 0 and self.suppress_prompt:
+            # nobody reads the message in non-interactive mode, so it must not look like a clean repo
+            raise Exception('None of upstreams resolved: ' + self.upstream)
+        self.upstream = ','.join(self.upstreams)
+        return len(self.upstreams) > 0
+
+    def _expand_upstreams(self, upstreams: [str]) -> [str]:
+        """Expands wildcard upstreams (like 'origin/release/*') to matching local and remote branches."""
+        if not any(map(lambda u: '*' in u, upstreams)):
+            return upstreams
+        reader = git_refs.RefReader(self.cwd)
+        known = list(reader.branches(git_refs.LOCAL_PREFIX)) + list(reader.branches(git_refs.REMOTE_PREFIX))
+        expanded = []
+        for upstream in upstreams:
+            if '*' in upstream:
+                expanded.extend(fnmatch.filter(known, upstream))
             else:
-                fallback()
-        return result
+                expanded.append(upstream)
+        return list(dict.fromkeys(expanded))
+
+    def find_merged_branches(self) -> set:
+        """Returns local branches reachable from any of upstreams with single ref walk."""
+        args = ['for-each-ref', '--format=%(refname:short)']
+        args.extend(map(lambda u: '--merged=' + u, self.upstreams))
+        args.append(git_refs.LOCAL_PREFIX)
+        return set(self.git.lines(args))
+
+    def find_squashed_branches(self, tips: {}, merged: set) -> set:
+        """Returns branches of `tips` (branch to its tip) not yet in `merged` which patches are in upstreams."""
+        candidates = filter(lambda e: e[0] not in merged and e[0] not in self.upstreams, tips.items())
+        squashed = SquashDetector(self.cwd, self.upstreams).find_merged(dict(candidates))
+        if len(squashed) > 0:
+            print('Found '+str(len(squashed))+' branches that were squashed or rebased to upstream('+self.upstream+')!')
+        return squashed
+
+    def delete_branches(self, branches: {}) -> {}:
+        """Deletes branches with single `git update-ref --stdin` transaction and logs them as one record.
+
+        `branches` maps branch to its tip seen at detection. Branches which moved since then are kept, transaction
+        verifies the same tips, so nothing is deleted if any of them moves meanwhile.
+        Returns map of deleted branch to its former tip.
+        """
+        tips = git_refs.RefReader(self.cwd).branches()
+        deleted = {}
+        for branch, sha in branches.items():
+            if tips.get(branch, None) == sha:
+                deleted[branch] = sha
+            elif branch in tips:
+                print('Kept branch ' + branch + ', it moved since it was found merged.')
+        if len(deleted) == 0:
+            return deleted
+        commands = map(lambda e: 'delete ' + git_refs.LOCAL_PREFIX + e[0] + ' ' + e[1] + '\n', deleted.items())
+        self._update_refs(''.join(commands))
+
+        for branch, sha in deleted.items():
+            print('Deleted branch ' + branch + ' (was ' + sha[:7] + ').')
+        record = json.dumps({
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'repo': self.cwd,
+            'deleted': deleted,
+        })
+        with open(self.log_file, mode='a') as f:
+            f.write(record + '\n')  # single append, so parallel cleanups never interleave records
+        return deleted
+
+    def restore_last_deleted(self) -> {}:
+        """Recreates branches deleted by last cleanup of this repository (according to log file)."""
+        last_record = None
+        if os.path.isfile(self.log_file):
+            with open(self.log_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # plain output of older versions
+                    if isinstance(record, dict) and record.get('repo', None) == self.cwd:
+                        last_record = record
+        if not last_record:
+            print('Nothing to restore for ' + self.cwd)
+            return {}
+
+        restored = last_record['deleted']
+        commands = map(lambda e: 'create ' + git_refs.LOCAL_PREFIX + e[0] + ' ' + e[1] + '\n', restored.items())
+        self._update_refs(''.join(commands))
+        for branch, sha in restored.items():
+            print('Restored branch ' + branch + ' (at ' + sha[:7] + ').')
+        return restored
+
+    def _update_refs(self, commands: str):
+        self.git.run(['update-ref', '--stdin'], input='start\n' + commands + 'prepare\ncommit\n')
 
 
 def find_dot_git(path):
     candidate = os.path.abspath(path)
+    while not os.path.exists(candidate + '/.git'):
+        parent = os.path.dirname(candidate)
+        if parent == candidate:
+            raise Exception('Not a git repository: ' + path)
+        candidate = parent
+    return candidate
 
-    if (os.path.exists(candidate + '/.git')):
-        return candidate
-    else:
-        return find_dot_git(os.path.dirname(candidate))
 
+def chunk_args(args: [str], max_length: int) -> [[str]]:
+    """Splits `args` into chunks which joined length does not exceed `max_length`."""
+    chunks = [[]]
+    length = 0
+    for arg in args:
+        if length + len(arg) + 1 > max_length and len(chunks[-1]) > 0:
+            chunks.append([])
+            length = 0
+        chunks[-1].append(arg)
+        length += len(arg) + 1
+    return chunks
+
+
+def push_statuses(porcelain: str) -> {}:
+    """Parses `git push --porcelain` output to map of remote ref to its `(flag, summary)`."""
+    statuses = {}
+    for line in porcelain.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 3:
+            statuses[fields[1].split(':', 1)[-1]] = (fields[0], fields[2])
+    return statuses
+
+
+def load_workspace(yaml_config: str) -> [(str, [str])]:
+    """Returns `(repo, upstreams)` pairs of multi-repo config, basements of repo are its upstreams."""
+    workspace = {}
+    for node in load_yaml(yaml_config):
+        if isinstance(node, dict) and 'repo' in node:
+            basements = workspace.setdefault(node['repo'], [])
+            if node['basement'] not in basements:
+                basements.append(node['basement'])
+    return list(workspace.items())
+
+
+def clean_repo(repo: str, upstreams: [str], log_file: str, detect_squashed: bool = False, remotes: [str] = None) -> {}:
+    """Non-interactive cleanup of single repo, returns its report instead of printing."""
+    output = io.StringIO()
+    report = {'repo': repo, 'deleted': {}, 'error': None}
+    with contextlib.redirect_stdout(output):
+        try:
+            cleaner = Cleaner(log_file=log_file, cwd=repo, upstream=upstreams, suppress_prompt=True,
+                              detect_squashed=detect_squashed, remotes=remotes)
+            report['repo'] = cleaner.cwd
+            report['deleted'] = cleaner.run()
+        except Exception as exc:
+            report['error'] = str(exc).strip()
+    report['output'] = output.getvalue()
+    return report
+
+
+def clean_workspace(repos: [(str, [str])], log_file: str, detect_squashed: bool = False, jobs: int = None,
+                    remotes: [str] = None) -> [{}]:
+    """Cleans every `(repo, upstreams)` in bounded process pool, reports are returned in order of `repos`."""
+    if len(repos) == 0:
+        return []
+    jobs = min(jobs or os.cpu_count() or 1, len(repos))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = list(map(lambda r: pool.submit(clean_repo, r[0], r[1], log_file, detect_squashed, remotes), repos))
+        return list(map(lambda f: f.result(), futures))
+
+
+def print_workspace_report(reports: [{}]) -> None:
+    width = max(map(lambda r: len(r['repo']), reports), default=0)
+    for report in reports:
+        if report['error']:
+            status = 'FAILED: ' + report['error'].splitlines()[0]
+        elif len(report['deleted']) == 0:
+            status = 'nothing to delete'
+        else:
+            status = 'deleted ' + ', '.join(sorted(report['deleted']))
+        print(report['repo'].ljust(width) + '  ' + status)
+    deleted = sum(map(lambda r: len(r['deleted']), reports))
+    failed = len(list(filter(lambda r: r['error'], reports)))
+    print('\nDeleted ' + str(deleted) + ' branches in ' + str(len(reports)) + ' repos, ' + str(failed) + ' failed')
 
-REPO_PATH = find_dot_git('../cleaner')
 
 def query_yes_no(question, default='yes'):
     '''Ask a yes/no question via raw_input() and return their answer.
@@ -144,11 +409,37 @@ pass
 
 
 if __name__ == '__main__':
-    args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description='Deletes local branches that were merged to upstream.')
+    parser.add_argument(dest='cwd', metavar='REPO', type=str, nargs='?', default='.',
+                        help='path to repository')
+    parser.add_argument(dest='upstreams', metavar='UPSTREAM', type=str, nargs='*', default=['origin/master'],
+                        help='branches with merged changes, wildcards like "origin/release/*" allowed')
+    parser.add_argument('--squashed', action='store_true',
+                        help='also detect branches that were squash- or rebase-merged to upstream')
+    parser.add_argument('--restore', action='store_true',
+                        help='recreate branches deleted by previous cleanup of repository')
+    parser.add_argument('--remote', dest='remotes', metavar='REMOTE', type=str, action='append',
+                        help='delete merged branches of remote (repeatable) and local branches which upstream is gone')
+    parser.add_argument('--workspace', metavar='CONFIG', type=str,
+                        help='non-interactive cleanup of every repo of multi-repo yaml config (basements are upstreams)')
+    parser.add_argument('--repos', metavar='REPO[=UPSTREAM]', type=str, nargs='+',
+                        help='non-interactive cleanup of listed repos, UPSTREAM arguments are used when omitted')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='max repos cleaned in parallel (default: number of CPUs)')
+    args = parser.parse_args()
+
+    if args.workspace or args.repos:
+        repos = load_workspace(args.workspace) if args.workspace else []
+        for repo in args.repos or []:
+            path, _, upstream = repo.partition('=')
+            repos.append((path, [upstream] if upstream else args.upstreams))
+        reports = clean_workspace(repos, log_file=LOG_FILE, detect_squashed=args.squashed, jobs=args.jobs,
+                                  remotes=args.remotes)
+        print_workspace_report(reports)
+        sys.exit(1 if any(map(lambda r: r['error'], reports)) else 0)
 
-    if len(sys.argv) > 2:
-        Cleaner(cwd=args[0], upstream=args[1]).run()
-    elif len(sys.argv) > 1:
-        Cleaner(cwd=args[0]).run()
+    cleaner = Cleaner(cwd=args.cwd, upstream=args.upstreams, detect_squashed=args.squashed, remotes=args.remotes)
+    if args.restore:
+        cleaner.restore_last_deleted()
     else:
-        Cleaner(cwd='.').run()
+        cleaner.run()
@@ -1,8 +1,12 @@
 from __future__ import print_function
 
+import glob
 import os
-import subprocess
+import stat
 import sys
+import branch_index
+import git_client
+import git_refs
 import workflow_updater
 from branch_filter import BranchFilter
 
@@ -20,6 +24,7 @@ class Switcher:
                  ) -> None:
         super().__init__()
         self._cwd = cwd
+        self._git = git_client.for_repo(cwd)
         self._dry_run = dry_run
         self._initial_input = initial_input
         self._input_provider = input_provider
@@ -40,9 +45,11 @@ class Switcher:
 
     def execute(self):
         builder_branches = self._extract_branches()
-        if self._initial_input and self._initial_input in builder_branches:
-            # we already got exact match!
-            checkout_branch = self._initial_input
+        # without config BranchFilter searches across local branches
+        candidates = builder_branches if len(builder_branches) > 0 else git_refs.RefReader(self._cwd).branches()
+        checkout_branch = branch_index.resolve_by_name(self._initial_input, candidates)
+        if checkout_branch:
+            # exact or unique match by name, no need to load commit messages
             print(f'-> Checkout target "{checkout_branch}"')
         else:
             branch_filter = BranchFilter(
@@ -57,7 +64,7 @@ class Switcher:
             print('Already there. Skipping checkout!')
             return
         print('-> Checking diff')
-        diff = self._capture_output('git diff HEAD')
+        diff = self._git.output(['diff', 'HEAD'])
         if len(diff) > 0:
             branch_config = self._resolve_head_branch_config_item(self._current_branch)
             expected_message = self._resolve_head_message(branch_config)
@@ -76,56 +83,39 @@ class Switcher:
     def _extract_branches(self) -> list[str]:
         if not self._builder:
             return []
-        builder_config = self._builder.config
-        output_branches = map(lambda e: e['output_branch'], builder_config)
+        output_branches = self._builder.index.outputs()
         return list(filter(lambda b: b != self._current_branch, output_branches)) # maybe keep current branch but change its message or mark it somehow?
 
     def _get_current_branch(self) -> str:
-        return self._capture_output('git branch --show-current').removesuffix('\n')
-
-    def _capture_output(self, cmd: str, fallback=None) -> str:
-        try:
-            return subprocess.check_output(cmd, cwd=self._cwd, universal_newlines=True, shell=True)
-        except subprocess.CalledProcessError as e:
-            print(e.output)
-            if fallback:
-                return fallback()
-            else:
-                raise e
+        return git_refs.RefReader(self._cwd).head_branch() or ''
 
     def _set_hooks_enabled(self, enabled: bool) -> None:
-        git_dir = self._cwd
-        while not os.path.exists(git_dir+'/.git'):
-            parent = os.path.dirname(git_dir)
-            if parent == git_dir:
-                break
-            git_dir = parent
-
-        if not os.path.exists(git_dir+'/.git'):
-            print('Failed to find git dir at ', execution_location_path)
-        if enabled:
-            executable = '+x'
-        else:
-            executable = '-x'
-        self._capture_output(f'chmod {executable} {git_dir}/.git/hooks/*-commit')
+        try:
+            hooks = glob.glob(os.path.join(git_refs.find_git_dir(self._cwd), 'hooks', '*-commit'))
+        except Exception:
+            print('Failed to find git dir at ', self._cwd)
+            return
+        executable = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+        for hook in hooks:
+            mode = os.stat(hook).st_mode
+            os.chmod(hook, mode | executable if enabled else mode & ~executable)
 
     def _commit(self, message: str, amend: bool):
         print('-> Disabling hooks')
         self._set_hooks_enabled(False)
 
         spec = ''
-        amend_arg = ''
+        amend_arg = []
         if amend:
             spec = '(to existing commit)'
-            amend_arg = '--amend'
+            amend_arg = ['--amend']
         if not message:
             message = 'WORK IN PROGRESS'
         print(f'-> Commiting with message: "{message}" {spec}')
         commit_exception = None
         try:
             if not DRY_RUN:
-                message = message.replace(' ', '\ ')
-                print(self._capture_output(f'git commit --no-verify  --all --message "{message}" {amend_arg}'))
+                print(self._git.output(['commit', '--no-verify', '--all', '--message=' + message] + amend_arg))
         except Exception as e:
             commit_exception = e
 
@@ -138,14 +128,14 @@ class Switcher:
 
     def _checkout(self, branch: str):
         if self._builder:
-            affected = workflow_updater.filter_affected(branch=self._current_branch, config=self._builder.config)
+            affected = self._builder.index.affected(self._current_branch)
             if len(affected) > 0:
                 update_list = list(map(lambda e: e['output_branch'], affected))
                 print(f'-> Going to update dependent branches: {update_list}')
                 self._builder.process_items(affected)
         print('-> Checking out')
         if not DRY_RUN:
-            print(self._capture_output('git checkout '+branch))
+            print(self._git.output(['checkout', branch]))
 
     def _try_soft_reset(self):
         if not self._soft_reset_after_checkout:
@@ -156,7 +146,7 @@ class Switcher:
         print(f'-> Soft reset to {dst}')
 
         if not DRY_RUN:
-            print(self._capture_output(f'git reset --soft {dst}'))
+            print(self._git.output(['reset', '--soft', dst]))
         print('Done!')
 
     def _resolve_head_message(self, branch_config_item: {}) -> str:
@@ -170,20 +160,15 @@ class Switcher:
     def _resolve_head_branch_config_item(self, current_branch: str) -> {}:
         if not self._builder:
             return None
-        builder_config: [{}] = self._builder.config
-        for item in builder_config:
-            if item['output_branch'] == current_branch:
-                return item
-
-        return None
+        items = self._builder.index.items_of(current_branch)
+        return items[0] if len(items) > 0 else None
 
     def _should_amend(self, branch_config: {}) -> bool:
         if not branch_config:
             return False
 
         basement_branch = branch_config['basement_branch']
-        basement_head = self._capture_output(f'git rev-parse {basement_branch}~0')
-        current_head = self._capture_output('git rev-parse HEAD~0')
+        basement_head, current_head = self._git.resolve([basement_branch + '~0', 'HEAD~0'])
 
         return current_head != basement_head
 
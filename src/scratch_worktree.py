@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import git_client
+from git_refs import find_git_dir
+
+CACHE_DIR = 'git-tools'
+WORKTREE_DIR = 'worktree'
+
+
+class ScratchWorktree:
+    """Reusable detached worktree at `.git/git-tools/worktree` where builds check out and cherry-pick.
+
+    User's checkout is never touched. Worktree and its index are kept between builds, so checkouts there only
+    rewrite files changed since previous build. Sparse worktree has only top-level files, git materializes
+    files of conflicting commits on demand.
+    """
+
+    def __init__(self, cwd: str, sparse: bool = True) -> None:
+        self.cwd = cwd
+        self.sparse = sparse
+        self.path = os.path.join(find_git_dir(cwd), CACHE_DIR, WORKTREE_DIR)
+        self.git = git_client.for_repo(cwd)
+
+    def prepare(self) -> str:
+        """Creates worktree on first use or drops leftovers of interrupted build, returns its path."""
+        scratch = git_client.for_repo(self.path)
+        if os.path.isfile(os.path.join(self.path, '.git')) and scratch.succeeds(['rev-parse', '--git-dir']):
+            # sequencer state of abandoned cherry-pick, files are reset by forced checkout of next build
+            scratch.run(['cherry-pick', '--quit'], check=False)
+            return self.path
+
+        if os.path.exists(self.path):  # registration was pruned or directory is broken
+            shutil.rmtree(self.path)
+        self.git.run(['worktree', 'prune'])
+        # without checkout, so sparse worktree never has all files written
+        self.git.run(['worktree', 'add', '--detach', '--no-checkout', self.path])
+        if self.sparse:
+            scratch.run(['sparse-checkout', 'set', '--cone'], check=False)
+        return self.path
+
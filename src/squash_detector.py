@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import json
+import os
+import re
+import git_client
+from git_refs import find_git_dir
+
+CACHE_DIR = 'git-tools'
+CACHE_FILE = 'patch_ids.json'
+CACHE_VERSION = 1
+NO_PATCH = ''  # commit or range with empty diff
+HEADER = re.compile(rb'^[0-9a-f]{40}$')
+
+
+class PatchIdCache:
+    """Persistent map of commit hash (or `base..tip` range) to its stable patch-id stored under `.git/`.
+
+    Patch-ids of immutable commits never change, so cache only grows as upstream advances.
+    """
+
+    def __init__(self, cwd: str) -> None:
+        self._path = os.path.join(find_git_dir(cwd), CACHE_DIR, CACHE_FILE)
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+            if data.get('version', None) == CACHE_VERSION:
+                self._entries = data.get('entries', {})
+        except (OSError, ValueError):
+            pass
+
+    def get(self, key: str) -> str:
+        return self._entries.get(key, None)
+
+    def put(self, key: str, patch_id: str) -> None:
+        self._entries[key] = patch_id
+        self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        tmp_path = self._path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, mode='w') as f:
+                json.dump({'version': CACHE_VERSION, 'entries': self._entries}, f)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            return
+        self._dirty = False
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+
+class SquashDetector:
+    """Finds branches which changes landed to upstreams as squashed or rebased commits.
+
+    Branch is squash-merged when its whole diff (since merge-base) has the same patch-id as some upstream commit,
+    and rebase-merged when every its commit has patch-id equal to some upstream commit.
+    Only upstream commits made after merge-bases are examined and their patch-ids are cached between runs.
+    """
+
+    def __init__(self, cwd: str, upstreams: [str], cache: PatchIdCache = None) -> None:
+        self.cwd = cwd
+        self.git = git_client.for_repo(cwd)
+        self.upstreams = upstreams
+        self.cache = cache if cache is not None else PatchIdCache(cwd)
+
+    def find_merged(self, tips: {}) -> set:
+        """Returns names of branches (given as map of name to tip hash) merged by squash or rebase."""
+        if len(tips) == 0:
+            return set()
+        branches = self._walk_branches(set(tips.values()))
+        bases = set()
+        for base, _ in branches.values():
+            if base:
+                bases.add(base)
+        if len(bases) == 0:
+            return set()
+
+        upstream_commits = self._upstream_commits_since(bases)
+        keys = list(upstream_commits)
+        for tip, (base, commits) in branches.items():
+            keys.extend(commits)
+            if base:
+                keys.append(base + '..' + tip)
+        self._compute_patch_ids(keys)
+
+        upstream_patches = set(map(self.cache.get, upstream_commits))
+        upstream_patches.discard(NO_PATCH)
+        merged_tips = set()
+        for tip, (base, commits) in branches.items():
+            if base and self.cache.get(base + '..' + tip) in upstream_patches:
+                merged_tips.add(tip)
+                continue
+            patches = list(filter(lambda p: p != NO_PATCH, map(self.cache.get, commits)))
+            if len(patches) > 0 and all(map(lambda p: p in upstream_patches, patches)):
+                merged_tips.add(tip)
+        self.cache.save()
+        return set(filter(lambda name: tips[name] in merged_tips, tips))
+
+    def _walk_branches(self, tips: set) -> {}:
+        """Maps each unmerged tip to `(merge_base, non_merge_commits)` with single `rev-list` over all tips.
+
+        `merge_base` is None when branch has several bases (it merged upstream in), so its whole diff is ambiguous.
+        """
+        output = self.git.output(['rev-list', '--parents'] + sorted(tips) + ['--not'] + self.upstreams)
+        parents = {}
+        for line in output.splitlines():
+            shas = line.split(' ')
+            parents[shas[0]] = shas[1:]
+
+        branches = {}
+        for tip in tips:
+            if tip not in parents:  # reachable from upstream
+                continue
+            commits = []
+            bases = set()
+            stack = [tip]
+            seen = set()
+            while len(stack) > 0:
+                commit = stack.pop()
+                if commit in seen:
+                    continue
+                seen.add(commit)
+                if commit not in parents:  # first commit reachable from upstream
+                    bases.add(commit)
+                    continue
+                if len(parents[commit]) == 1:
+                    commits.append(commit)
+                stack.extend(parents[commit])
+            branches[tip] = (bases.pop() if len(bases) == 1 else None, commits)
+        return branches
+
+    def _upstream_commits_since(self, bases: set) -> [str]:
+        if len(bases) > 1:
+            oldest = self.git.output(['merge-base', '--octopus'] + sorted(bases)).strip()
+        else:
+            oldest = next(iter(bases))
+        if not oldest:
+            return []
+        return self.git.lines(['rev-list', '--no-merges'] + self.upstreams + ['^' + oldest])
+
+    def _compute_patch_ids(self, keys: [str]) -> None:
+        """Computes patch-ids of all uncached commits and ranges with single `diff-tree | patch-id` pipeline."""
+        missing = list(dict.fromkeys(filter(lambda k: k not in self.cache, keys)))
+        if len(missing) == 0:
+            return
+        # "<tip> <base>" line is read as commit with custom parent, so diff-tree shows base..tip diff
+        request = ''.join(map(lambda k: ' '.join(reversed(k.split('..'))) + '\n', missing))
+        diffs = self.git.run(['diff-tree', '--stdin', '-p', '--always', '--root'], input=request.encode(),
+                             text=False).stdout
+
+        # diff-tree prints header (first hash of input line) for each input line, same tip may appear
+        # in several lines so headers are replaced with "commit <index>" which is what patch-id reports back
+        lines = []
+        index = -1
+        for line in diffs.split(b'\n'):
+            if len(line) == 40 and HEADER.match(line):
+                index += 1
+                line = ('commit ' + format(index, '040x')).encode()
+            lines.append(line)
+        patch_ids = self.git.run(['patch-id', '--stable'], input=b'\n'.join(lines), text=False).stdout.decode()
+        found = {}
+        for line in patch_ids.splitlines():
+            patch_id, commit = line.split(' ')
+            found[int(commit, 16)] = patch_id
+        for i, key in enumerate(missing):
+            self.cache.put(key, found.get(i, NO_PATCH))
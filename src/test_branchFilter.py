@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 from queue import Queue
 
+import io
+import os
+import threading
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import branch_metadata
 import testenv
-from branch_filter import BranchFilter
+from branch_index import BranchIndex, resolve_by_name
+from branch_filter import BranchFilter, SOURCE_REMOTE, create_tracking_branch
+from metadata_cache import MetadataCache
 
 
 class TestBranchFilter(testenv.TestEnvTestCase):
@@ -12,6 +22,10 @@ class TestBranchFilter(testenv.TestEnvTestCase):
         self.under_test = BranchFilter(cwd=self.test_repo_dir,
                                        input_provider=lambda : self.pop_input())
 
+    def tearDown(self):
+        self.under_test.wait_until_loaded()
+        super().tearDown()
+
     def test_find_dev_branch_by_commit_message_part(self):
         self.set_input('dev_file')
         self.assertEqual('dev', self.under_test.find_one())
@@ -25,6 +39,139 @@ class TestBranchFilter(testenv.TestEnvTestCase):
         self.set_input('feature', '', '_1')
         self.assertEqual('feature_1', self.under_test.find_one())
 
+    def test_exact_branch_name_wins_over_partial_matches(self):
+        self.set_input('feature_1')
+        under_test = BranchFilter(cwd=self.test_repo_dir,
+                                  custom_branches=['feature_1', 'feature_1_extra'],
+                                  input_provider=lambda: self.pop_input())
+        self.assertEqual('feature_1', under_test.find_one())
+
+    def test_many_selected_by_name_and_message(self):
+        self.set_input('feature', 'dev_file', '')
+        selected = self.under_test.find_many()
+        self.assertEqual(['feature_2', 'feature_1', 'dev'], selected)
+        self.assertEqual(['master', 'hotfix'], self.under_test.remaining_branches)
+
+    def test_long_session_does_not_hit_recursion_limit(self):
+        self.set_input(*(['no_such_branch'] * 3000 + ['']))
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual([], self.under_test.find_many())
+
+    def test_long_list_truncated_to_screen_height(self):
+        under_test = BranchFilter(cwd=self.test_repo_dir,
+                                  synthetic_branches=list(map(
+                                      lambda i: {'name': 'branch_' + str(i), 'commit': 'commit ' + str(i), 'ref': None},
+                                      range(0, 100))))
+        output = io.StringIO()
+        with mock.patch.dict(os.environ, {'LINES': '20'}), redirect_stdout(output):
+            under_test.print_remains_or_selected()
+        lines = output.getvalue().splitlines()
+        self.assertLessEqual(len(lines), 20)
+        self.assertIn('branch_0  | commit 0', lines)
+        self.assertIn('... and 86 more (type to narrow)', lines)
+
+    def test_names_filtered_before_messages_loaded(self):
+        self.under_test.wait_until_loaded()
+        self.run_cmd('rm -rf .git/git-tools')  # drop messages cached by filter from setUp
+        release = threading.Event()
+        original = branch_metadata.resolve_revisions
+        def slow_resolve(cwd, revisions, cache=None):
+            release.wait()
+            return original(cwd, revisions, cache)
+
+        with mock.patch.object(branch_metadata, 'resolve_revisions', slow_resolve):
+            under_test = BranchFilter(cwd=self.test_repo_dir)
+            output = io.StringIO()
+            with redirect_stdout(output):
+                under_test.print_remains_or_selected()
+            self.assertIn('feature_1 | ...', output.getvalue())
+
+            under_test.find_single_branch('feature')
+            self.assertEqual(['feature_2', 'feature_1'], under_test.selected_branches)
+
+            threading.Timer(0.1, release.set).start()
+            under_test.find_single_branch('f1_file')  # matches only message, so waits for loader
+            self.assertEqual(['feature_1'], under_test.selected_branches)
+
+    def test_head_commits_loaded_for_all_branches(self):
+        self.under_test.wait_until_loaded()
+        self.assertEqual('add "dev_file"', self.under_test.head_commits['dev'])
+        self.assertEqual('add "f1_file"', self.under_test.head_commits['feature_1'])
+        self.assertEqual('upd README', self.under_test.head_commits['master'])
+
+    def test_loader_saves_cache_once_without_holding_lock(self):
+        self.under_test.wait_until_loaded()
+        self.run_cmd('rm -rf .git/git-tools')
+        saves = []
+        created = threading.Event()
+        original = branch_metadata.resolve_revisions
+        def resolve_once_created(cwd, revisions, cache=None):
+            created.wait()
+            return original(cwd, revisions, cache)
+
+        with mock.patch('branch_filter.BACKGROUND_CHUNK', 1), \
+                mock.patch.object(branch_metadata, 'resolve_revisions', resolve_once_created), \
+                mock.patch.object(MetadataCache, 'save', lambda cache: saves.append(under_test._lock._is_owned())):
+            under_test = BranchFilter(cwd=self.test_repo_dir)
+            created.set()
+            under_test.wait_until_loaded()
+            self.assertEqual([False], saves)  # saved before waiters are released
+            under_test._loader.join()
+        self.assertEqual([False], saves)
+
+    def test_synthetic_branches_resolved_by_ref(self):
+        under_test = BranchFilter(cwd=self.test_repo_dir,
+                                  synthetic_branches=[
+                                      {'name': 'shadow/feature_1/2', 'commit': None, 'ref': 'feature_1~2'},
+                                      {'name': 'shadow/missing/0', 'commit': None, 'ref': 'missing~0'},
+                                      {'name': 'custom', 'commit': 'custom message', 'ref': 'dev~0'},
+                                  ])
+        under_test.wait_until_loaded()
+        self.assertEqual('add "f1_to_be_deleted"', under_test.head_commits['shadow/feature_1/2'])
+        self.assertEqual('<BRANCH NOT FOUND>', under_test.head_commits['shadow/missing/0'])
+        self.assertEqual('custom message', under_test.head_commits['custom'])
+
+    def test_remote_branches_listed_without_resolving_messages(self):
+        self.run_cmd('git remote add origin .', 'git fetch origin', 'git checkout master', 'git branch -D hotfix',
+                     'rm -rf .git/git-tools')  # drop metadata cached by local filter
+        under_test = BranchFilter(cwd=self.test_repo_dir, source=SOURCE_REMOTE, initial_input='hotfix',
+                                  input_provider=lambda: self.pop_input())
+        self.assertEqual(['origin/master', 'origin/hotfix', 'origin/feature_2', 'origin/feature_1', 'origin/dev'],
+                         under_test.all_branches)
+        self.assertEqual({}, under_test.head_commits)
+
+        self.assertEqual('origin/hotfix', under_test.find_one())
+        self.assertEqual({'origin/hotfix': 'add "hotfix_file"'}, under_test.head_commits)
+
+        self.assertEqual('hotfix', under_test.as_local_branch('origin/hotfix'))
+        upstream = testenv.capture_cmd_output('git rev-parse --abbrev-ref hotfix@{upstream}')
+        self.assertEqual('origin/hotfix\n', upstream)
+
+    def test_existing_branch_without_upstream_starts_tracking_remote(self):
+        self.run_cmd('git remote add origin .', 'git fetch --quiet origin')
+        self.assertEqual('feature_1', create_tracking_branch('origin/feature_1', self.test_repo_dir))
+        upstream = testenv.capture_cmd_output('git rev-parse --abbrev-ref feature_1@{upstream}')
+        self.assertEqual('origin/feature_1\n', upstream)
+
+    def test_existing_branch_tracking_other_branch_needs_confirmation(self):
+        self.run_cmd('git remote add origin .', 'git fetch --quiet origin',
+                     'git branch --quiet --set-upstream-to=origin/dev feature_1')
+        with redirect_stdout(io.StringIO()):
+            self.assertIsNone(create_tracking_branch('origin/feature_1', self.test_repo_dir, lambda: 'n'))
+            self.assertEqual('feature_1', create_tracking_branch('origin/feature_1', self.test_repo_dir, lambda: 'y'))
+        upstream = testenv.capture_cmd_output('git rev-parse --abbrev-ref feature_1@{upstream}')
+        self.assertEqual('origin/dev\n', upstream)
+
+    def test_diverged_branch_needs_confirmation(self):
+        self.run_cmd('git remote add origin .', 'git fetch --quiet origin',
+                     'git branch --quiet --set-upstream-to=origin/feature_1 feature_1',
+                     'git checkout --quiet feature_1', 'git commit --quiet --amend --message "diverged"',
+                     'git checkout --quiet master')
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertIsNone(create_tracking_branch('origin/feature_1', self.test_repo_dir, lambda: ''))
+        self.assertIn('(1 ahead, 1 behind)', output.getvalue())
+
     def pop_input(self):
         self.assertFalse(self.input_queue.empty(), 'Queue is empty but input requested!')
         input = self.input_queue.get()
@@ -34,3 +181,97 @@ class TestBranchFilter(testenv.TestEnvTestCase):
     def set_input(self, *params):
         for param in params:
             self.input_queue.put(param)
+
+
+class TestMetadataCache(testenv.TestEnvTestCase):
+    def test_unchanged_tips_are_not_resolved_again(self):
+        branch_metadata.load_branches(self.test_repo_dir)
+        self.run_cmd('git checkout dev', 'git commit --allow-empty --message "moved dev"')
+
+        resolved = []
+        original = branch_metadata.resolve_revisions
+        def tracking_resolve(cwd, revisions, cache=None):
+            resolved.extend(revisions)
+            return original(cwd, revisions, cache)
+        branch_metadata.resolve_revisions = tracking_resolve
+        try:
+            branches = branch_metadata.load_branches(self.test_repo_dir)
+        finally:
+            branch_metadata.resolve_revisions = original
+
+        self.assertEqual(1, len(resolved))
+        subjects = dict(map(lambda b: (b.name, b.subject), branches))
+        self.assertEqual('moved dev', subjects['dev'])
+        self.assertEqual('add "f2_file"', subjects['feature_2'])
+
+    def test_least_recently_used_entries_evicted(self):
+        cache = MetadataCache(self.test_repo_dir, capacity=2)
+        cache.put('a' * 40, subject='a', author='A <a@a>', date=1)
+        cache.put('b' * 40, subject='b', author='B <b@b>', date=2)
+        cache.get('a' * 40)
+        cache.put('c' * 40, subject='c', author='C <c@c>', date=3)
+        cache.save()
+
+        reloaded = MetadataCache(self.test_repo_dir, capacity=2)
+        self.assertIn('a' * 40, reloaded)
+        self.assertNotIn('b' * 40, reloaded)
+        self.assertEqual('c', reloaded.get('c' * 40)['subject'])
+
+    def test_recency_of_hits_saved_without_misses(self):
+        cache = MetadataCache(self.test_repo_dir, capacity=2)
+        cache.put('a' * 40, subject='a', author='A <a@a>', date=1)
+        cache.put('b' * 40, subject='b', author='B <b@b>', date=2)
+        cache.save()
+
+        hits_only = MetadataCache(self.test_repo_dir, capacity=2)
+        hits_only.get('a' * 40)
+        hits_only.save()
+
+        reloaded = MetadataCache(self.test_repo_dir, capacity=2)
+        reloaded.put('c' * 40, subject='c', author='C <c@c>', date=3)
+        reloaded.save()
+        self.assertIn('a' * 40, MetadataCache(self.test_repo_dir, capacity=2))
+        self.assertNotIn('b' * 40, MetadataCache(self.test_repo_dir, capacity=2))
+
+
+class TestBranchIndex(unittest.TestCase):
+    def setUp(self):
+        self.under_test = BranchIndex(
+            branches=['fix_login', 'login', 'login_form', 'feature'],
+            subjects={'fix_login': 'fix', 'login': 'login page', 'login_form': 'form', 'feature': 'uses LOGIN api'})
+
+    def test_ranked_exact_prefix_substring_subject(self):
+        self.assertEqual(['login', 'login_form', 'fix_login', 'feature'], self.under_test.search('Login'))
+
+    def test_short_queries_without_ngrams(self):
+        self.assertEqual(['fix_login', 'feature', 'login_form'], self.under_test.search('f'))
+
+    def test_equally_ranked_results_keep_branch_order(self):
+        under_test = BranchIndex(branches=['zeta', 'alpha', 'mid', 'beta'],
+                                 subjects={'zeta': 'shared fix', 'alpha': 'shared fix', 'beta': 'shared fix'})
+        self.assertEqual(['zeta', 'alpha', 'beta'], under_test.search('shared'))
+        under_test.update_subject('mid', 'shared too')
+        self.assertEqual(['zeta', 'alpha', 'mid', 'beta'], under_test.search('shared'))
+
+    def test_narrowed_within_previous_results(self):
+        self.assertEqual(['fix_login'], self.under_test.search('fix', within=['fix_login', 'login']))
+        self.assertEqual([], self.under_test.search('form', within=['fix_login', 'login']))
+
+    def test_updated_subject_found(self):
+        self.assertEqual([], self.under_test.search('hotfix'))
+        self.under_test.update_subject('feature', 'hotfix for release')
+        self.assertEqual(['feature'], self.under_test.search('hotfix'))
+
+    def test_replaced_subject_no_longer_found(self):
+        self.under_test.update_subject('feature', 'hotfix for release')
+        self.assertEqual(['fix_login'], self.under_test.search('log', within=['fix_login', 'feature']))
+        self.assertEqual([], self.under_test.search('api'))
+
+    def test_resolved_by_name_only_when_unique(self):
+        branches = ['fix_login', 'login', 'login_form', 'feature']
+        self.assertEqual('login', resolve_by_name('LOGIN', branches))
+        self.assertEqual('feature', resolve_by_name('fea', branches))
+        self.assertEqual('login_form', resolve_by_name('_form', branches))
+        self.assertIsNone(resolve_by_name('log', branches))  # ambiguous prefix
+        self.assertIsNone(resolve_by_name('in', branches))  # ambiguous substring
+        self.assertIsNone(resolve_by_name('api', branches))
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 import os
 
+import cherry_picker
 import testenv
+import tree_picker
 
 
 class TestF1UpdateUnderF2(testenv.RepoTestCase):
+    in_memory = False
 
     def setUp(self):
         super().setUp()
-        self.undertest = testenv.repo_picker(
+        self.undertest = self.picker(
             target_branch='feature_2',
             basement_branch='feature_1',
             branches_to_cherry_pick=['feature_2']
@@ -38,7 +41,7 @@ class TestF1UpdateUnderF2(testenv.RepoTestCase):
         self.assertTrue(self.undertest.up_to_date())
 
     def test_non_existing_branch_created(self):
-        self.undertest = testenv.repo_picker(
+        self.undertest = self.picker(
             target_branch='new_branch',
             basement_branch='dev',
             branches_to_cherry_pick=['hotfix']
@@ -48,7 +51,7 @@ class TestF1UpdateUnderF2(testenv.RepoTestCase):
         self.assertTrue(os.path.exists(testenv.REPO_DIR + '/hotfix_file'))
 
     def test_cherry_pick_can_be_empty(self):
-        self.undertest = testenv.repo_picker(
+        self.undertest = self.picker(
             target_branch='new_branch_on_top',
             basement_branch='feature_1',
             branches_to_cherry_pick=[]
@@ -57,6 +60,34 @@ class TestF1UpdateUnderF2(testenv.RepoTestCase):
 
         self.assertTrue(os.path.exists(testenv.REPO_DIR + '/f1_file'))
 
+    def test_custom_message_applied_with_original_author(self):
+        self.run_cmd('git checkout feature_2',
+                     'git commit --amend --no-edit --author "Other <other@email.com>"')
+        self.undertest = self.picker_with_message('custom "feature_2" message')
+        self.amend_f1_and_ch_f2()
+        self.cherry_pick()
+        self.assertEqual('Other\ncustom "feature_2" message\n\n',
+                         testenv.capture_cmd_output('git log -1 --format=%an%n%B feature_2'))
+
+    def test_conflict_with_custom_message_rolled_back(self):
+        self.run_cmd(
+            'git checkout feature_1',
+            'echo conflict > f2_file',
+            'git add f2_file',
+            'git commit --amend --message "add f1 and f2 files"',
+        )
+        self.undertest = self.picker_with_message('custom "feature_2" message')
+        self.undertest.input_provider = lambda: 'no'
+        self.assertFalse(self.undertest.run())
+        self.assertEqual('', testenv.capture_cmd_output('git status --short'))
+
+    def picker_with_message(self, message):
+        return cherry_picker.Picker(target_branch='feature_2', basement_branch='feature_1',
+                                    branch_contents=[{cherry_picker.CONTENT_COMMIT: 'feature_2',
+                                                      cherry_picker.CONTENT_MESSAGE: message}],
+                                    log_file=testenv.TEST_LOG_FILE, cwd=testenv.REPO_DIR,
+                                    input_provider=cherry_picker.always_confirm, in_memory=self.in_memory)
+
     def amend_f1_and_ch_f2(self):
         self.run_cmd(
             "git checkout feature_1",
@@ -67,3 +98,52 @@ class TestF1UpdateUnderF2(testenv.RepoTestCase):
 
     def cherry_pick(self):
         self.undertest.run()
+
+    def picker(self, target_branch, basement_branch, branches_to_cherry_pick):
+        return testenv.repo_picker(target_branch, basement_branch, branches_to_cherry_pick, in_memory=self.in_memory)
+
+
+class TestF1UpdateUnderF2InMemory(TestF1UpdateUnderF2):
+    in_memory = True
+
+    def cherry_pick(self):
+        head = testenv.capture_cmd_output('git rev-parse --abbrev-ref HEAD')
+        self.undertest.run()
+        self.assertEqual(head, testenv.capture_cmd_output('git rev-parse --abbrev-ref HEAD'))
+        self.run_cmd('git checkout ' + self.undertest.target_branch)
+
+    def test_checked_out_target_moved_with_worktree(self):
+        self.amend_f1_and_ch_f2()
+        self.undertest.run()
+        self.assertEqual('', testenv.capture_cmd_output('git status --short'))
+        self.assertTrue(os.path.exists(testenv.REPO_DIR + '/f2_file'))
+        self.assertEqual(testenv.capture_cmd_output('git rev-parse feature_1'),
+                         testenv.capture_cmd_output('git rev-parse feature_2~1'))
+
+    def test_author_and_message_kept(self):
+        self.amend_f1_and_ch_f2()
+        log_format = 'git log -1 --format=%an%n%ae%n%ad%n%B feature_2'
+        before = testenv.capture_cmd_output(log_format)
+        self.cherry_pick()
+        self.assertEqual(before, testenv.capture_cmd_output(log_format))
+
+    def test_synthetic_merge_base_matches_merge_base_option(self):
+        self.amend_f1_and_ch_f2()
+        replayer = tree_picker.TreeReplayer(testenv.REPO_DIR)
+        replayer.options = {tree_picker.WRITE_TREE_OPTION}  # as git < 2.40
+        tree = replayer.merge(replayer.rev_parse('feature_2~1'), replayer.rev_parse('feature_1'),
+                              replayer.rev_parse('feature_2'))
+        self.cherry_pick()
+        self.assertEqual(testenv.capture_cmd_output('git rev-parse feature_2^{tree}').strip(), tree)
+
+    def test_conflict_continues_in_worktree(self):
+        self.run_cmd(
+            'git checkout feature_1',
+            'echo conflict > f2_file',
+            'git add f2_file',
+            'git commit --amend --message "add f1 and f2 files"',
+            'git checkout master',
+        )
+        self.undertest.input_provider = lambda: 'no'
+        self.assertFalse(self.undertest.run())
+        self.assertEqual('', testenv.capture_cmd_output('git status --short'))
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
+import json
 import os
+import shutil
 import subprocess
 import unittest
 
@@ -10,6 +12,8 @@ TEST_DIR = os.path.abspath(os.path.dirname(__file__)+'/../tests')
 
 REPO_DIR = TEST_DIR + '/repo'
 TEST_LOG_FILE = REPO_DIR + '/delete_test.log'
+WORKTREE_DIR = TEST_DIR + '/worktree'
+ORIGIN_DIR = '/tmp/test_repos/origin.git'
 
 
 class CleanMergedTestCase(testenv.TestEnvTestCase):
@@ -56,6 +60,19 @@ class CleanMergedTestCase(testenv.TestEnvTestCase):
             self.assertTrue('hotfix' in contents)
             self.assertTrue('dev' in contents)
 
+    def test_log_record_lists_deleted_tips(self):
+        with open(TEST_LOG_FILE) as f:
+            record = json.loads(f.readlines()[-1])
+        self.assertEqual(self.test_repo_dir, record['repo'])
+        self.assertEqual(['dev', 'hotfix'], sorted(record['deleted']))
+
+    def test_restore_recreates_deleted_branches(self):
+        with open(TEST_LOG_FILE) as f:
+            deleted = json.loads(f.readlines()[-1])['deleted']
+        run_cleaner.Cleaner(cwd=self.test_repo_dir, log_file=TEST_LOG_FILE).restore_last_deleted()
+        for branch, sha in deleted.items():
+            self.assertEqual(sha, self.capture_cmd_output('git rev-parse ' + branch).strip())
+
     def capture_cmd_output(self, command):
         with subprocess.Popen(command,
                               shell=True,
@@ -81,5 +98,222 @@ class CleanMergedTestCase(testenv.TestEnvTestCase):
                     self.fail('failed to execute command:' + command)
 
 
+class CleanBranchesInWorktreesTestCase(testenv.TestEnvTestCase):
+    def tearDown(self):
+        if os.path.exists(WORKTREE_DIR):
+            shutil.rmtree(WORKTREE_DIR)
+        super().tearDown()
+
+    def test_branch_checked_out_in_worktree_kept(self):
+        self.run_cmd(
+            'git checkout master',
+            'git merge dev',
+            'git merge hotfix --message "hotifx merged after dev"',
+            'git worktree add ' + WORKTREE_DIR + ' hotfix',
+        )
+        run_cleaner.Cleaner(
+            cwd=self.test_repo_dir,
+            upstream='master',
+            suppress_prompt=True,
+            input_provider=lambda : '',
+            log_file=TEST_LOG_FILE
+        ).run()
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['feature_1', 'feature_2', 'hotfix', 'master'], branches)
+
+
+class CleanMovedBranchTestCase(testenv.TestEnvTestCase):
+    def test_branch_moved_after_detection_kept(self):
+        self.run_cmd(
+            'git checkout master',
+            'git merge dev',
+            'git merge hotfix --message "hotifx merged after dev"',
+        )
+        def move_dev_while_prompting():
+            self.run_cmd('git branch --force dev feature_1')
+            return ''
+
+        deleted = run_cleaner.Cleaner(
+            cwd=self.test_repo_dir,
+            upstream='master',
+            input_provider=move_dev_while_prompting,
+            log_file=TEST_LOG_FILE
+        ).run()
+        self.assertEqual(['hotfix'], list(deleted))
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['dev', 'feature_1', 'feature_2', 'master'], branches)
+        self.assertEqual(testenv.capture_cmd_output('git rev-parse feature_1'),
+                         testenv.capture_cmd_output('git rev-parse dev'))
+
+
+class CleanMergedToManyUpstreamsTestCase(testenv.TestEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_cmd(
+            'git checkout master',
+            'git branch release/1 feature_1',
+        )
+
+        run_cleaner.Cleaner(
+            cwd=self.test_repo_dir,
+            upstream=['hotfix', 'release/*'],
+            suppress_prompt=True,
+            input_provider=lambda : '',
+            log_file=TEST_LOG_FILE
+        ).run()
+
+    def test_branches_merged_to_any_upstream_deleted(self):
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['feature_2', 'hotfix', 'master', 'release/1'], branches)
+
+
+class CleanSquashedTestCase(testenv.TestEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_cmd(
+            'git checkout master',
+            'git merge --squash dev',
+            'git commit --message "squashed dev"',
+            'git cherry-pick hotfix',
+        )
+
+    def test_squashed_and_rebased_branches_deleted(self):
+        self.clean(detect_squashed=True)
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['feature_1', 'feature_2', 'master'], branches)
+        self.assertTrue(os.path.isfile(REPO_DIR + '/.git/git-tools/patch_ids.json'))
+
+    def test_squashed_branches_kept_by_default(self):
+        self.clean(detect_squashed=False)
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['dev', 'feature_1', 'feature_2', 'hotfix', 'master'], branches)
+
+    def clean(self, detect_squashed: bool):
+        run_cleaner.Cleaner(
+            cwd=self.test_repo_dir,
+            upstream='master',
+            suppress_prompt=True,
+            input_provider=lambda : '',
+            log_file=TEST_LOG_FILE,
+            detect_squashed=detect_squashed
+        ).run()
+
+
+class CleanWorkspaceTestCase(testenv.TestEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self._repo1 = testenv.RepoHelper(self, '/tmp/test_repos/repo1')
+        self._repo1.init_repo()
+        self._repo1.run_cmd('git checkout master', 'git merge dev')
+        self._repo2 = testenv.RepoHelper(self, '/tmp/test_repos/repo2')
+        self._repo2.init_repo()
+        self._repo2.run_cmd('git checkout master', 'git merge hotfix')
+
+    def tearDown(self):
+        self._repo1.cleanup()
+        self._repo2.cleanup()
+        super().tearDown()
+
+    def test_each_repo_cleaned_against_own_upstream(self):
+        reports = run_cleaner.clean_workspace(
+            run_cleaner.load_workspace(TEST_DIR + '/multi_repo_workspace.yml'), log_file=TEST_LOG_FILE, jobs=2)
+        self.assertEqual([['dev'], ['hotfix']], list(map(lambda r: sorted(r['deleted']), reports)))
+        self.assertEqual(['/tmp/test_repos/repo1', '/tmp/test_repos/repo2'], list(map(lambda r: r['repo'], reports)))
+
+    def test_failed_repo_reported_without_stopping_others(self):
+        reports = run_cleaner.clean_workspace([('/tmp/test_repos/repo1', ['master']),
+                                               ('/tmp/test_repos/repo2', ['missing'])], log_file=TEST_LOG_FILE)
+        self.assertEqual(['dev'], list(reports[0]['deleted']))
+        self.assertEqual({}, reports[1]['deleted'])
+        self.assertEqual('None of upstreams resolved: missing', reports[1]['error'])
+
+    def test_find_dot_git_fails_outside_of_repo(self):
+        self.assertRaises(Exception, run_cleaner.find_dot_git, '/')
+
+
+class CleanRemoteTestCase(testenv.TestEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        if os.path.exists(ORIGIN_DIR):
+            shutil.rmtree(ORIGIN_DIR)
+        self.run_cmd(
+            'git checkout master',
+            'git clone --quiet --bare . ' + ORIGIN_DIR,
+            'git remote add origin ' + ORIGIN_DIR,
+            'git fetch --quiet origin',
+            'git merge dev',
+            'git merge hotfix --message "hotifx merged after dev"',
+            'git push --quiet origin master',
+            'git branch --set-upstream-to=origin/dev dev',
+            'git branch --set-upstream-to=origin/feature_1 feature_1',
+        )
+
+    def tearDown(self):
+        if os.path.exists(ORIGIN_DIR):
+            shutil.rmtree(ORIGIN_DIR)
+        super().tearDown()
+
+    def test_merged_remote_branches_deleted(self):
+        self.clean()
+        remote_branches = testenv.capture_cmd_output('git ls-remote --heads origin').splitlines()
+        self.assertEqual(['refs/heads/feature_1', 'refs/heads/feature_2', 'refs/heads/master'],
+                         list(map(lambda line: line.split('\t')[1], remote_branches)))
+
+    def test_remote_counterpart_of_local_upstream_kept(self):
+        self.run_cmd('git commit --allow-empty --message "master ahead of origin"')
+        self.assertEqual('', testenv.capture_cmd_output('git rev-parse --verify --quiet origin/HEAD'))
+        self.clean(upstream='master')
+        remote_branches = testenv.capture_cmd_output('git ls-remote --heads origin').splitlines()
+        self.assertIn('refs/heads/master', list(map(lambda line: line.split('\t')[1], remote_branches)))
+
+    def test_local_branches_with_gone_upstream_deleted(self):
+        self.clean()
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['feature_1', 'feature_2', 'hotfix', 'master'], branches)
+
+    def test_unmerged_branch_with_gone_upstream_kept(self):
+        self.run_cmd('git push --quiet origin --delete feature_1', 'git fetch --quiet --prune origin')
+        self.clean()
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['feature_1', 'feature_2', 'hotfix', 'master'], branches)
+
+    def test_gone_branches_kept_without_upstream(self):
+        self.run_cmd('git push --quiet origin --delete dev', 'git fetch --quiet --prune origin')
+        run_cleaner.Cleaner(
+            cwd=self.test_repo_dir,
+            upstream='origin/missing',
+            input_provider=lambda : self.fail('nothing to select without upstream'),
+            log_file=TEST_LOG_FILE,
+            remotes=['origin']
+        ).run()
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['dev', 'feature_1', 'feature_2', 'hotfix', 'master'], branches)
+
+    def test_rejected_remote_branch_reported_and_cleanup_continues(self):
+        with open(ORIGIN_DIR + '/hooks/update', 'w') as hook:
+            hook.write('#!/bin/sh\n[ "$1" != refs/heads/hotfix ]\n')
+        os.chmod(ORIGIN_DIR + '/hooks/update', 0o755)
+        self.clean()
+        remote_branches = testenv.capture_cmd_output('git ls-remote --heads origin').splitlines()
+        self.assertEqual(['refs/heads/feature_1', 'refs/heads/feature_2', 'refs/heads/hotfix', 'refs/heads/master'],
+                         list(map(lambda line: line.split('\t')[1], remote_branches)))
+        branches = testenv.capture_cmd_output('git branch --format="%(refname:short)"').splitlines()
+        self.assertEqual(['feature_1', 'feature_2', 'hotfix', 'master'], branches)
+
+    def test_push_split_into_chunks(self):
+        self.assertEqual([['a' * 10, 'b' * 10], ['c' * 10]],
+                         run_cleaner.chunk_args(['a' * 10, 'b' * 10, 'c' * 10], 25))
+
+    def clean(self, upstream='origin/master'):
+        run_cleaner.Cleaner(
+            cwd=self.test_repo_dir,
+            upstream=upstream,
+            suppress_prompt=True,
+            input_provider=lambda : '',
+            log_file=TEST_LOG_FILE,
+            remotes=['origin']
+        ).run()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import git_client
+import testenv
+
+
+class TestGit(testenv.TestEnvTestCase):
+    def setUp(self):
+        super().setUp()
+        self.git = git_client.for_repo(self.test_repo_dir)
+
+    def test_shared_per_repo(self):
+        self.assertIs(self.git, git_client.for_repo(self.test_repo_dir + '/'))
+
+    def test_resolve_in_batch(self):
+        expected = self.git.output(['rev-parse', 'master', 'dev~1']).splitlines()
+        self.assertEqual(expected + [None], self.git.resolve(['master', 'dev~1', 'missing_branch']))
+
+    def test_coprocess_sees_updated_refs(self):
+        self.git.resolve(['dev'])
+        self.run_cmd('git checkout dev', 'git commit --allow-empty --message "moved dev"')
+        self.assertEqual(self.git.output(['rev-parse', 'dev']).strip(), self.git.resolve(['dev'])[0])
+
+    def test_coprocess_survives_recreated_repo(self):
+        self.git.resolve(['dev'])
+        self.cleanup()
+        self.init_repo()
+        self.run_cmd('git checkout dev', 'git commit --allow-empty --message "new repo"')
+        self.assertEqual(self.git.output(['rev-parse', 'dev']).strip(), self.git.resolve(['dev'])[0])
+
+    def test_read_objects(self):
+        name, object_type, contents = self.git.read_objects(['master^{commit}'])[0]
+        self.assertEqual('commit', object_type)
+        self.assertIn(b'upd README', contents)
+        self.assertIsNone(self.git.read_objects(['missing_branch'])[0])
+
+    def test_failed_command_raises_git_error(self):
+        with self.assertRaises(git_client.GitError) as error:
+            self.git.run(['checkout', 'missing_branch'])
+        self.assertEqual(['git', 'checkout', 'missing_branch'], error.exception.command)
+        self.assertNotEqual(0, error.exception.returncode)
+        self.assertFalse(self.git.succeeds(['checkout', 'missing_branch']))
+
+    def test_stream_passes_lines_and_keeps_bounded_tail(self):
+        blob = self.git.output(['hash-object', '-w', '--stdin'], input='line\n' * 100000).strip()
+        streamed = []
+        result = self.git.stream(['cat-file', '-p', blob], on_stdout=streamed.append, retain=1000)
+        self.assertEqual(100000, len(streamed))
+        self.assertLessEqual(len(''.join(result.stdout.lines())), 1000)
+        self.assertEqual(100000 - len(result.stdout.lines()), result.stdout.dropped)
+
+    def test_failed_stream_reports_stderr(self):
+        with self.assertRaises(git_client.GitError) as error:
+            self.git.stream(['checkout', 'missing_branch'])
+        self.assertIn('missing_branch', error.exception.stderr)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+
+import testenv
+from git_refs import RefReader
+
+WORKTREE_DIR = testenv.TEST_DIR + '/worktree'
+
+
+class TestRefReader(testenv.TestEnvTestCase):
+    def tearDown(self):
+        if os.path.exists(WORKTREE_DIR):
+            shutil.rmtree(WORKTREE_DIR)
+        super().tearDown()
+
+    def test_loose_refs_match_git(self):
+        self.assertEqual(self.git_refs(), RefReader(self.test_repo_dir).refs())
+
+    def test_packed_refs_match_git(self):
+        self.run_cmd('git pack-refs --all',
+                     'git checkout dev',
+                     'git commit --allow-empty --message "loose dev"')
+        self.assertTrue(os.path.exists(self.test_repo_dir + '/.git/packed-refs'))
+        self.assertEqual(self.git_refs(), RefReader(self.test_repo_dir).refs())
+
+    def test_prefix_with_and_without_trailing_slash(self):
+        self.run_cmd('git update-ref refs/headsX/other master', 'git pack-refs --all')
+        reader = RefReader(self.test_repo_dir)
+        self.assertEqual(self.git_refs(), reader.refs('refs/heads'))
+        self.assertEqual(self.git_refs(), reader.refs('refs/heads/'))
+        self.assertEqual(['dev', 'feature_1', 'feature_2', 'hotfix', 'master'],
+                         list(reader.branches('refs/heads').keys()))
+
+    def test_short_branch_names(self):
+        self.assertEqual(['dev', 'feature_1', 'feature_2', 'hotfix', 'master'],
+                         list(RefReader(self.test_repo_dir).branches().keys()))
+
+    def test_head_branch(self):
+        self.run_cmd('git checkout feature_1')
+        self.assertEqual('feature_1', RefReader(self.test_repo_dir).head_branch())
+
+    def test_detached_head(self):
+        self.run_cmd('git checkout --detach dev')
+        self.assertIsNone(RefReader(self.test_repo_dir).head_branch())
+
+    def test_worktree_uses_own_head_and_shared_refs(self):
+        self.run_cmd('git checkout master', 'git worktree add ' + WORKTREE_DIR + ' hotfix')
+        reader = RefReader(WORKTREE_DIR)
+        self.assertEqual('hotfix', reader.head_branch())
+        self.assertEqual(self.git_refs(), reader.refs())
+
+    def git_refs(self) -> {}:
+        output = subprocess.check_output('git for-each-ref --format="%(refname) %(objectname)" refs/heads/',
+                                         cwd=self.test_repo_dir, universal_newlines=True, shell=True)
+        return dict(map(lambda line: tuple(line.split(' ')), output.splitlines()))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 from queue import Queue
+from unittest import mock
 
 import testenv
 from run_switcher import Switcher
@@ -11,9 +12,9 @@ class TestSwitcher(testenv.RepoTestCase):
         self.input_queue = Queue()
         self.under_test = self.create_sut()
 
-    def create_sut(self):
+    def create_sut(self, initial_input: str = None):
         return Switcher(cwd=testenv.REPO_DIR,
-                        initial_input=None,
+                        initial_input=initial_input,
                         workflow_config=testenv.REPO_DIR + '/../single_base_workspace.yml',
                         input_provider=lambda: self.pop_input(),
                         dry_run=False,
@@ -39,6 +40,19 @@ class TestSwitcher(testenv.RepoTestCase):
         self.repo_helper.assertOnBranch('feature_1')
         self.repo_helper.assertFileAmended('dev_file')
 
+    def test_unique_name_match_skips_branch_filter(self):
+        with mock.patch('run_switcher.BranchFilter', side_effect=AssertionError('filter should not be used')):
+            self.create_sut(initial_input='_2').execute()
+            self.repo_helper.assertOnBranch('feature_2')
+
+            self.create_sut(initial_input='De').execute()
+            self.repo_helper.assertOnBranch('dev')
+
+    def test_ambiguous_initial_input_narrowed_by_filter(self):
+        self.set_input('_1')
+        self.create_sut(initial_input='feature').execute()
+        self.repo_helper.assertOnBranch('feature_1')
+
     def pop_input(self):
         self.assertFalse(self.input_queue.empty(), 'Queue is empty but input requested!')
         input = self.input_queue.get()
@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
+import contextlib
+import io
+import json
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import unittest
 from queue import Queue
+from unittest import mock
 
+import build_scheduler
 import cherry_picker
 import testenv
+import tracing
 import workflow_updater
+from revision_resolver import RevisionResolver
+from scratch_worktree import ScratchWorktree
 from workflow_updater import WorkflowBuilder
 
 
@@ -29,6 +41,8 @@ class WorkFlowTestCase(testenv.RepoTestCase):
 
 
 class MultiAmendTestCase(WorkFlowTestCase):
+    in_memory = False
+
     def setUp(self):
         super().setUp()
         self.amend(branch='feature_1', amended_file='f1_file')
@@ -37,7 +51,8 @@ class MultiAmendTestCase(WorkFlowTestCase):
         self.run_cmd('git checkout feature_2')
         WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/single_base_workspace.yml',
                         cwd=testenv.REPO_DIR,
-                        input_provider=cherry_picker.always_confirm).start()
+                        input_provider=cherry_picker.always_confirm,
+                        in_memory=self.in_memory).start()
 
     def test_feature1_file_amended(self):
         self.assertFileAmended('f1_file')
@@ -59,7 +74,69 @@ class MultiAmendTestCase(WorkFlowTestCase):
         self.assertTrue(os.path.exists(testenv.REPO_DIR + '/f1_to_be_deleted'), 'file not found!')
 
 
+class MultiAmendInMemoryTestCase(MultiAmendTestCase):
+    in_memory = True
+
+
+class ScratchWorktreeTestCase(WorkFlowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.amend(branch='feature_1', amended_file='f1_file')
+        self.amend(branch='feature_2', amended_file='f2_file')
+        self.run_cmd('git checkout master')
+
+    def build(self, input_provider=cherry_picker.always_confirm):
+        WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/single_base_workspace.yml',
+                        cwd=testenv.REPO_DIR,
+                        input_provider=input_provider,
+                        force_update=True,
+                        scratch=True).start()
+
+    def test_branches_built_without_touching_checkout(self):
+        self.build()
+        self.assertEqual('master\n', self.capture('git rev-parse --abbrev-ref HEAD'))
+        self.assertEqual('', self.capture('git status --short'))
+        self.assertEqual('f1_file file amended!\n', self.capture('git show feature_2:f1_file'))
+        self.assertEqual('f2_file file amended!\n', self.capture('git show feature_2:f2_file'))
+        self.assertCommitMessage(branch='feature_1', expected_message='custom commit on "feature_1" branch')
+
+    def test_scratch_worktree_reused_detached(self):
+        scratch = ScratchWorktree(testenv.REPO_DIR)
+        self.build()
+        index = os.stat(scratch.path + '/.git').st_ino
+        self.build()
+        self.assertEqual(index, os.stat(scratch.path + '/.git').st_ino)
+        self.assertNotIn('branch ', self.capture('git worktree list --porcelain').split(scratch.path)[1])
+        self.assertEqual('f2_file file amended!\n', self.capture('git show feature_2:f2_file'))
+
+    def test_checked_out_target_is_left_untouched(self):
+        self.run_cmd('git checkout feature_2')
+        before = self.capture('git rev-parse feature_2')
+        self.build()
+        self.assertEqual(before, self.capture('git rev-parse feature_2'))
+
+    def test_conflict_abort_keeps_checkout(self):
+        self.run_cmd(
+            'git checkout feature_1',
+            'echo conflict > f2_file',
+            'git add f2_file',
+            'git commit --amend --message "add f1 and f2 files"',
+            'git checkout master'
+        )
+        before = self.capture('git rev-parse feature_2')
+        answers = iter(['yes', 'yes', 'no'])  # dev and feature_1 are built, conflict of feature_2 is not resolved
+        self.build(input_provider=lambda: next(answers))
+        self.assertEqual('master\n', self.capture('git rev-parse --abbrev-ref HEAD'))
+        self.assertEqual('', self.capture('git status --short'))
+        self.assertEqual(before, self.capture('git rev-parse feature_2'))
+
+    def capture(self, command):
+        return testenv.capture_cmd_output(command)
+
+
 class MultiBasementBranchTestCase(WorkFlowTestCase):
+    jobs = 1
+
     def setUp(self):
         super().setUp()
         self.amend(branch='master', amended_file='README.md')
@@ -71,7 +148,8 @@ class MultiBasementBranchTestCase(WorkFlowTestCase):
 
         WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/multi_base_workspace.yml',
                         cwd=testenv.REPO_DIR,
-                        input_provider=cherry_picker.always_confirm).start()
+                        input_provider=cherry_picker.always_confirm,
+                        jobs=self.jobs).start()
 
     def test_feature1_file_amended(self):
         self.run_cmd('git checkout feature_1')
@@ -107,6 +185,278 @@ class MultiBasementBranchTestCase(WorkFlowTestCase):
         pass
 
 
+class MultiBasementBranchParallelTestCase(MultiBasementBranchTestCase):
+    jobs = 4
+
+
+class ParallelFailureTestCase(WorkFlowTestCase):
+    def test_conflict_cancels_only_dependents(self):
+        self.amend(branch='master', amended_file='README.md')
+        self.run_cmd(
+            'git checkout dev',
+            'echo conflict > f1_file',
+            'git add f1_file',
+            'git commit --amend --message "add dev file with conflict"',
+            'git checkout master'
+        )
+        feature_1 = testenv.capture_cmd_output('git rev-parse feature_1')
+        hotfix = testenv.capture_cmd_output('git rev-parse hotfix')
+
+        WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/multi_base_workspace.yml',
+                        cwd=testenv.REPO_DIR,
+                        input_provider=cherry_picker.always_confirm,
+                        jobs=4).start()
+
+        self.assertEqual(feature_1, testenv.capture_cmd_output('git rev-parse feature_1'))
+        self.assertNotEqual(hotfix, testenv.capture_cmd_output('git rev-parse hotfix'))
+        self.assertEqual(testenv.capture_cmd_output('git rev-parse master'),
+                         testenv.capture_cmd_output('git rev-parse hotfix~1'))
+
+
+class SequentialFallbackTestCase(WorkFlowTestCase):
+    def test_fallback_without_write_tree_reported(self):
+        self.amend(branch='master', amended_file='README.md')
+        output = io.StringIO()
+        with mock.patch.object(workflow_updater.TreeReplayer, 'supported', lambda replayer: False), \
+                contextlib.redirect_stdout(output):
+            WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/multi_base_workspace.yml',
+                            cwd=testenv.REPO_DIR,
+                            input_provider=cherry_picker.always_confirm,
+                            quiet=True,
+                            jobs=4).start()
+        self.assertIn('Building sequentially, --jobs needs git with "merge-tree --write-tree"', output.getvalue())
+        self.assertEqual(testenv.capture_cmd_output('git rev-parse master'),
+                         testenv.capture_cmd_output('git rev-parse hotfix~1'))
+
+
+class BuildSchedulerTestCase(unittest.TestCase):
+    def test_chains_depend_on_branches_they_read_or_rebuild(self):
+        depends_on = build_scheduler.dependencies(
+            ['dev', 'feature_1', 'hotfix', 'dev'],
+            [{'master'}, {'dev', 'feature_1'}, {'master', 'hotfix'}, {'master', 'dev'}])
+        self.assertEqual({0: set(), 1: {0}, 2: set(), 3: {0, 1}}, depends_on)
+
+    def test_failure_cancels_only_dependents(self):
+        built = []
+        states = build_scheduler.run_graph(['a', 'b', 'c', 'd'], {'b': {'a'}, 'c': {'b'}},
+                                           lambda node: built.append(node) or node != 'a', jobs=2)
+        self.assertEqual({'a': build_scheduler.FAILED, 'b': build_scheduler.CANCELLED,
+                          'c': build_scheduler.CANCELLED, 'd': build_scheduler.DONE}, states)
+        self.assertEqual(['a', 'd'], sorted(built))
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def task(node):
+            with lock:
+                running.append(node)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(node)
+            return True
+
+        states = build_scheduler.run_graph(list(range(6)), {}, task, jobs=2)
+        self.assertEqual(2, max(peak))
+        self.assertTrue(all(map(lambda s: s == build_scheduler.DONE, states.values())))
+
+
+class ConfigIndexTestCase(unittest.TestCase):
+    def item(self, basement, output):
+        return {workflow_updater.BASEMENT: basement, workflow_updater.OUTPUT: output,
+                workflow_updater.BRANCH_CONTENTS: []}
+
+    def outputs(self, items):
+        return list(map(lambda i: i[workflow_updater.OUTPUT], items))
+
+    def test_affected_are_unique_and_topologically_ordered(self):
+        # diamond: dev and hotfix are both rebuilt on master, release is rebuilt on dev and then again on hotfix
+        index = workflow_updater.ConfigIndex([
+            self.item('release', 'docs'),
+            self.item('master', 'dev'),
+            self.item('dev', 'release'),
+            self.item('master', 'hotfix'),
+            self.item('hotfix', 'release'),
+        ])
+        affected = self.outputs(index.affected('master'))
+        self.assertEqual(['dev', 'release', 'hotfix', 'release', 'docs'], affected)
+
+    def test_deep_chain_is_linear(self):
+        config = list(map(lambda i: self.item('b' + str(i), 'b' + str(i + 1)), range(2000)))
+        index = workflow_updater.ConfigIndex(config)
+        self.assertEqual(list(map(lambda i: 'b' + str(i), range(1, 2001))), self.outputs(index.affected('b0')))
+
+    def test_items_of_output(self):
+        index = workflow_updater.ConfigIndex([self.item('master', 'dev'), self.item('dev', 'feature')])
+        self.assertEqual(['feature'], self.outputs(index.items_of('feature')))
+        self.assertEqual([], index.items_of('master'))
+        self.assertEqual(['dev', 'feature'], index.outputs())
+
+    def test_cycle_does_not_hang(self):
+        index = workflow_updater.ConfigIndex([self.item('a', 'b'), self.item('b', 'a')])
+        self.assertEqual(['b', 'a'], self.outputs(index.affected('a')))
+
+
+class ConfigCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '--quiet', self.directory])
+        self.config = os.path.join(self.directory, 'map.yml')
+        shutil.copy(testenv.TEST_DIR + '/single_base_workspace.yml', self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def builder(self, cwd=None):
+        return WorkflowBuilder(yaml_config=self.config, cwd=cwd or self.directory)
+
+    def test_unchanged_config_is_not_parsed_again(self):
+        parsed = self.builder().config
+        cache_path = workflow_updater.config_cache_path(self.config, self.directory)
+        self.assertTrue(os.path.isfile(cache_path))
+        self.assertEqual(os.path.join(self.directory, '.git', 'git-tools'), os.path.dirname(cache_path))
+        self.assertEqual(['.git', 'map.yml'], sorted(os.listdir(self.directory)))
+        with mock.patch.object(workflow_updater, 'load_yaml', side_effect=AssertionError('parsed again')):
+            self.assertEqual(parsed, self.builder().config)
+
+    def test_changed_config_is_parsed_again(self):
+        self.builder()
+        with open(self.config, mode='a') as f:
+            f.write('\n  - hotfix~0\n')
+        self.assertIn('hotfix', self.builder().index.outputs())
+
+    def test_changed_parser_invalidates_cache(self):
+        self.builder()
+        changed_parser = os.path.join(self.directory, 'workflow_updater.py')
+        with open(changed_parser, mode='w') as f:
+            f.write('# parser of another version\n')
+        with mock.patch.object(workflow_updater, '__file__', changed_parser), \
+                mock.patch.object(workflow_updater, 'load_yaml', wraps=workflow_updater.load_yaml) as load:
+            self.builder()
+        self.assertEqual(1, load.call_count)
+
+    def test_config_cached_per_cwd(self):
+        self.builder()
+        other_cwd = os.path.join(self.directory, 'subdir')
+        with mock.patch.object(workflow_updater, 'load_yaml', wraps=workflow_updater.load_yaml) as load:
+            self.builder(cwd=other_cwd)
+            self.builder(cwd=other_cwd)
+            self.builder()
+        self.assertEqual(1, load.call_count)
+
+
+class PlanTestCase(WorkFlowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.amend(branch='master', amended_file='README.md')
+
+    def plan(self, predict_conflicts=False):
+        return WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/multi_base_workspace.yml',
+                               cwd=testenv.REPO_DIR).plan(predict_conflicts=predict_conflicts)
+
+    def items(self, plan):
+        return dict(map(lambda i: (i['branch'], i), plan['items']))
+
+    def test_plan_reasons_without_touching_repo(self):
+        refs = testenv.capture_cmd_output('git for-each-ref')
+        plan = self.plan()
+        items = self.items(plan)
+        self.assertEqual(['dev', 'feature_1', 'hotfix', 'non_existing_branch', 'empty_new_branch'], plan['rebuild'])
+        self.assertEqual('basement of branch has changed (master)', items['dev']['reason'])
+        self.assertEqual('basement will be rebuilt (dev)', items['feature_1']['reason'])
+        self.assertEqual('branch yet not exists', items['non_existing_branch']['reason'])
+        self.assertEqual(3, items['feature_1']['commits'])
+        self.assertFalse(items['feature_1']['conflicts_checked'])
+        self.assertEqual(refs, testenv.capture_cmd_output('git for-each-ref'))
+        self.assertEqual('', testenv.capture_cmd_output('git status --short'))
+        self.assertEqual('master\n', testenv.capture_cmd_output('git rev-parse --abbrev-ref HEAD'))
+
+    def test_plan_predicts_conflicts(self):
+        self.run_cmd(
+            'git checkout dev',
+            'echo conflict > f1_file',
+            'git add f1_file',
+            'git commit --amend --message "add dev file with conflict"',
+            'git checkout master'
+        )
+        items = self.items(self.plan(predict_conflicts=True))
+        self.assertTrue(items['dev']['conflicts_checked'])
+        self.assertIsNone(items['dev']['conflict'])
+        self.assertEqual('feature_1~0', items['feature_1']['conflict'])
+
+    def test_plan_writes_no_objects_by_default(self):
+        self.run_cmd('git gc --quiet --prune=now')
+        objects = testenv.capture_cmd_output('git count-objects -v')
+        self.plan()
+        self.assertEqual(objects, testenv.capture_cmd_output('git count-objects -v'))
+
+    def test_built_branches_are_not_planned_and_timed(self):
+        WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/multi_base_workspace.yml',
+                        cwd=testenv.REPO_DIR,
+                        input_provider=cherry_picker.always_confirm,
+                        quiet=True).start()
+        plan = WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/multi_base_workspace.yml',
+                               cwd=testenv.REPO_DIR, force_update=True).plan()
+        self.assertEqual(5, len(plan['rebuild']))
+        self.assertEqual('forced', self.items(plan)['hotfix']['reason'])
+        self.assertIsNotNone(plan['estimated_seconds'])
+        self.assertEqual([], self.plan()['rebuild'])
+
+
+class TracingTestCase(WorkFlowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.amend(branch='feature_1', amended_file='f1_file')
+        self.directory = tempfile.mkdtemp()
+        self.tracer = tracing.start()
+        try:
+            WorkflowBuilder(yaml_config=testenv.TEST_DIR + '/single_base_workspace.yml',
+                            cwd=testenv.REPO_DIR,
+                            input_provider=cherry_picker.always_confirm,
+                            quiet=True).start()
+        finally:
+            tracing.stop()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_git_steps_traced_with_branch_and_exit_code(self):
+        picks = list(filter(lambda s: s['name'] == 'git cherry-pick', self.tracer.spans))
+        self.assertGreater(len(picks), 0)
+        self.assertEqual(['feature_2'], list(map(lambda s: s['args']['branch'], picks)))
+        self.assertTrue(all(map(lambda s: s['args']['exit_code'] == 0, picks)))
+        self.assertIn('flow', list(map(lambda s: s['name'], self.tracer.spans)))
+
+    def test_exports(self):
+        chrome = os.path.join(self.directory, 'trace.json')
+        self.tracer.export(chrome)
+        with open(chrome) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(len(self.tracer.spans), len(events))
+        self.assertEqual({'X'}, set(map(lambda e: e['ph'], events)))
+
+        jsonl = os.path.join(self.directory, 'trace.jsonl')
+        self.tracer.export(jsonl)
+        with open(jsonl) as f:
+            lines = list(map(json.loads, f))
+        self.assertIn('git checkout', list(map(lambda l: l['name'], lines)))
+
+    def test_summary_lists_slowest_steps(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.tracer.print_summary(limit=3)
+        slowest = output.getvalue().split('Time per operation:')[0].splitlines()
+        self.assertEqual('Slowest steps:', slowest[0])
+        self.assertEqual(3, len(slowest[1:]))
+
+    def test_nothing_traced_when_stopped(self):
+        workflow_updater.git_client.for_repo(testenv.REPO_DIR).run(['status'])
+        self.assertIsNone(tracing.stop())
+
+
 class ConflictsTestCase(WorkFlowTestCase):
     def setUp(self):
         self.input_queue = Queue()
@@ -217,6 +567,33 @@ class ConflictsTestCase(WorkFlowTestCase):
             return stdout
 
 
+class PreflightTestCase(WorkFlowTestCase):
+    def test_missing_revision_fails_before_building(self):
+        self.amend(branch='feature_1', amended_file='f1_file')
+        config = testenv.REPO_DIR + '/missing_revision.yml'
+        with open(config, mode='w') as f:
+            f.write('- master:\n  - dev~0\n  - feature_1:\n    - no_such_branch~0\n')
+        dev_before = testenv.capture_cmd_output('git rev-parse dev')
+
+        builder = WorkflowBuilder(yaml_config=config, cwd=testenv.REPO_DIR, input_provider=cherry_picker.always_confirm)
+        with self.assertRaises(Exception) as error:
+            builder.process_items(builder.config)
+        self.assertIn('no_such_branch~0', str(error.exception))
+        self.assertEqual(dev_before, testenv.capture_cmd_output('git rev-parse dev'))
+
+    def test_revisions_of_rebuilt_branch_resolved_again(self):
+        resolver = RevisionResolver(testenv.REPO_DIR)
+        resolved = resolver.resolve(['dev', 'dev~1', 'master', 'unknown'])
+        self.assertEqual(testenv.capture_cmd_output('git rev-parse master').strip(), resolved['dev~1'])
+        self.assertIsNone(resolved['unknown'])
+
+        self.amend(branch='dev', amended_file='dev_file')
+        self.assertEqual(resolved['dev'], resolver.get('dev'))
+        resolver.invalidate('dev')
+        self.assertEqual(testenv.capture_cmd_output('git rev-parse dev').strip(), resolver.get('dev'))
+        self.assertEqual(resolved['master'], resolver.get('master'))
+
+
 class MultiReposTestCase(WorkFlowTestCase):
     def setUp(self):
         super().setUp()
@@ -246,5 +623,50 @@ class MultiReposTestCase(WorkFlowTestCase):
     def test_repo2_processed_with_repo2_config(self):
         self._repo2.assertCommitMessage(branch='dev', expected_message='edited by repo2 config')
 
+class WorkspaceBuildTestCase(WorkFlowTestCase):
+    def setUp(self):
+        super().setUp()
+        self._repo1 = testenv.RepoHelper(self, '/tmp/test_repos/repo1')
+        self._repo1.init_repo()
+        self._repo1.amend(branch='master', amended_file='README.md')
+
+        self._repo2 = testenv.RepoHelper(self, '/tmp/test_repos/repo2')
+        self._repo2.init_repo()
+        self._repo2.amend(branch='hotfix', amended_file='hotfix_file')
+        self._repo2.run_cmd('git checkout master')
+
+    def tearDown(self):
+        self._repo1.cleanup()
+        self._repo2.cleanup()
+        super().tearDown()
+
+    def test_workspace_nodes_grouped_by_repo(self):
+        repos = workflow_updater.load_workspace(testenv.TEST_DIR + '/multi_repo_workspace.yml')
+        self.assertEqual(['/tmp/test_repos/repo1', '/tmp/test_repos/repo2'], list(map(lambda r: r[0], repos)))
+        self.assertEqual(['master'], list(map(lambda n: n['basement'], repos[0][1])))
+
+    def test_node_without_repo_rejected(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.yml') as config:
+            config.write('- repo: /tmp/test_repos/repo1\n  basement: master\n  branches:\n    - hotfix~0\n'
+                         '- master:\n    - dev~0\n')
+            config.flush()
+            self.assertRaises(Exception, workflow_updater.load_workspace, config.name)
+
+    def test_every_repo_built_with_own_config(self):
+        reports = workflow_updater.build_workspace(testenv.TEST_DIR + '/multi_repo_workspace.yml', jobs=2)
+        self.assertEqual([None, None], list(map(lambda r: r['error'], reports)))
+        self.assertEqual(['hotfix', 'dev'], reports[0]['affected'])
+        self.assertEqual(['dev'], reports[1]['affected'])
+        self._repo1.assertOnBranch('master')
+        self._repo1.assertCommitMessage(branch='dev', expected_message='edited by repo1 config')
+        self._repo2.assertCommitMessage(branch='dev', expected_message='edited by repo2 config')
+
+    def test_failed_repo_reported(self):
+        self._repo2.run_cmd('echo changes > README.md')
+        reports = workflow_updater.build_workspace(testenv.TEST_DIR + '/multi_repo_workspace.yml', jobs=2)
+        self.assertIsNone(reports[0]['error'])
+        self.assertIsNotNone(reports[1]['error'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,7 @@ import shutil
 import subprocess
 import unittest
 import cherry_picker
+import git_client
 
 TEST_DIR = os.path.dirname(os.path.dirname(__file__)) + '/tests'
 
@@ -11,7 +12,7 @@ REPO_DIR = TEST_DIR + '/repo'
 TEST_LOG_FILE = TEST_DIR + '/test.log'
 ENABLE_REPO_CACHING = False
 
-def repo_picker(target_branch, basement_branch, branches_to_cherry_pick):
+def repo_picker(target_branch, basement_branch, branches_to_cherry_pick, in_memory=False):
     branch_contents = list(map(lambda e: {
         cherry_picker.CONTENT_COMMIT: e,
         cherry_picker.CONTENT_MESSAGE: None
@@ -22,7 +23,8 @@ def repo_picker(target_branch, basement_branch, branches_to_cherry_pick):
                                 log_file=TEST_LOG_FILE,
                                 cwd=REPO_DIR,
                                 verbose_ouput=True,
-                                input_provider=cherry_picker.always_confirm)
+                                input_provider=cherry_picker.always_confirm,
+                                in_memory=in_memory)
 
 
 def capture_cmd_output(command):
@@ -115,30 +117,19 @@ class RepoHelper:
         )
 
     def assertOnBranch(self, branch: str):
-        current = self._capture_output('git branch --show-current').removesuffix('\n')
+        current = git_client.for_repo(self._repo_dir).output(['branch', '--show-current']).removesuffix('\n')
         self._test_case.assertEqual(branch, current)
 
-    def _capture_output(self, cmd: str) -> str:
-        return subprocess.check_output(cmd, cwd=REPO_DIR, universal_newlines=True, shell=True)
-
     def assertCommitMessage(self, branch: str, expected_message: str):
         self.run_cmd('git checkout ' + branch)
-        command = 'git log -1 --oneline'
-        with subprocess.Popen(command,
-                              shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              universal_newlines=True,
-                              cwd=self._repo_dir) as p:
-            retcode = p.wait()
-            if retcode != 0:
-                self._test_case.fail('failed to execute command:' + command + "\nOutput:\n" +
-                          '\n'.join(p.stdout.readlines()) + '\nError output:\n' +
-                          '\n'.join(p.stderr.readlines()))
-            out = ''.join(p.stdout.readlines())
-
-            self._test_case.assertTrue(expected_message in out, msg='Commit message not contains "' + expected_message + '"! ' +
-                                                         'Instead got:' + out)
+        result = git_client.for_repo(self._repo_dir).run(['log', '-1', '--oneline'], check=False)
+        if result.returncode != 0:
+            self._test_case.fail('failed to execute command: git log -1 --oneline\nOutput:\n' + result.stdout +
+                                 '\nError output:\n' + result.stderr)
+        out = result.stdout
+
+        self._test_case.assertTrue(expected_message in out, msg='Commit message not contains "' + expected_message + '"! ' +
+                                                     'Instead got:' + out)
 
     def assertFileAmended(self, file: str):
         with open(self._repo_dir + '/' + file, mode='r') as f:
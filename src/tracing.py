@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import contextlib
+import json
+import os
+import threading
+import time
+
+SUMMARY_SIZE = 10
+JSONL_SUFFIX = '.jsonl'
+
+_tracer = None
+_context = threading.local()  # stack of args of open spans, nested spans inherit branch of outer ones
+
+
+class Tracer:
+    """Collects finished spans: name, start, duration and args (command, branch, exit code)."""
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, duration: float, args: {}) -> None:
+        with self._lock:
+            self.spans.append({'name': name, 'start': start - self.origin, 'duration': duration,
+                               'thread': threading.get_ident(), 'args': args})
+
+    def export(self, path: str) -> None:
+        """Writes spans as JSONL (for `.jsonl` files) or as Chrome trace (chrome://tracing, Perfetto)."""
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, mode='w') as f:
+            if path.endswith(JSONL_SUFFIX):
+                for s in spans:
+                    print(json.dumps(dict({'name': s['name'], 'start': s['start'], 'duration': s['duration']},
+                                          **s['args'])), file=f)
+                return
+            events = list(map(lambda s: {'name': s['name'], 'cat': s['name'].split(' ')[0], 'ph': 'X',
+                                         'ts': round(s['start'] * 1e6), 'dur': round(s['duration'] * 1e6),
+                                         'pid': os.getpid(), 'tid': s['thread'], 'args': s['args']}, spans))
+            json.dump({'traceEvents': events}, f)
+
+    def print_summary(self, limit: int = SUMMARY_SIZE) -> None:
+        """Prints slowest git steps and total time per git operation."""
+        with self._lock:
+            steps = list(filter(lambda s: 'command' in s['args'], self.spans))
+        if len(steps) == 0:
+            return
+        print('Slowest steps:')
+        for s in sorted(steps, key=lambda s: s['duration'], reverse=True)[:limit]:
+            branch = s['args'].get('branch', None)
+            print('  ' + format(s['duration'], '8.3f') + 's  ' + ('[' + branch + '] ' if branch else '') +
+                  'git ' + s['args']['command'][:100])
+        totals = {}
+        for s in steps:
+            count, seconds = totals.get(s['name'], (0, 0.0))
+            totals[s['name']] = (count + 1, seconds + s['duration'])
+        print('Time per operation:')
+        for name, (count, seconds) in sorted(totals.items(), key=lambda e: e[1][1], reverse=True)[:limit]:
+            print('  ' + format(seconds, '8.3f') + 's  ' + name + ' (' + str(count) + 'x)')
+
+
+def start() -> Tracer:
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop() -> Tracer:
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+@contextlib.contextmanager
+def span(name: str, **args):
+    """Times enclosed block when tracing is started, yields args so block can add results (like exit code)."""
+    tracer = _tracer
+    if tracer is None:
+        yield args
+        return
+    stack = getattr(_context, 'stack', None)
+    if stack is None:
+        stack = _context.stack = []
+    if 'branch' not in args and len(stack) > 0 and 'branch' in stack[-1]:
+        args['branch'] = stack[-1]['branch']
+    stack.append(args)
+    start_time = time.perf_counter()
+    try:
+        yield args
+    finally:
+        tracer.add(name, start_time, time.perf_counter() - start_time, args)
+        stack.pop()
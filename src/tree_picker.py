@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import os
+import git_client
+
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+WRITE_TREE_OPTION = '--write-tree'
+MERGE_BASE_OPTION = '--merge-base'
+
+_merge_tree_options = None
+
+
+class ReplayConflict(Exception):
+    """Commit can not be replayed without working tree (conflict, merge commit, old git)."""
+    pass
+
+
+def merge_tree_options(cwd: str) -> set:
+    """Returns options of `git merge-tree` relevant for replaying, probed once per process."""
+    global _merge_tree_options
+    if _merge_tree_options is None:
+        result = git_client.for_repo(cwd).run(['merge-tree', '-h'], check=False)
+        usage = result.stdout + result.stderr
+        _merge_tree_options = set(filter(lambda o: o in usage, (WRITE_TREE_OPTION, MERGE_BASE_OPTION)))
+    return _merge_tree_options
+
+
+class TreeReplayer:
+    """Cherry-picks commits purely in object database: `git merge-tree --write-tree` + `git commit-tree`.
+
+    Neither working tree nor index are touched, so replaying does not depend on repository size.
+    Git without `merge-tree --merge-base` (< 2.40) is handled by merging synthetic commits which only merge-base
+    is a copy of picked commit parent.
+    """
+
+    def __init__(self, cwd: str) -> None:
+        self.cwd = cwd
+        self.git = git_client.for_repo(cwd)
+        self.options = merge_tree_options(cwd)
+
+    def supported(self) -> bool:
+        return WRITE_TREE_OPTION in self.options
+
+    def replay(self, onto: str, commit: str, message: str = None) -> str:
+        """Creates copy of `commit` on top of `onto` keeping author (and message unless given), returns its hash."""
+        headers, original_message = self.read_commit(commit)
+        parents = headers.get('parent', [])
+        if len(parents) > 1:
+            raise ReplayConflict('merge commit ' + commit)
+        base = parents[0] if parents else None
+
+        tree = self.merge(base, onto, commit)
+        # same as in worktree engine: custom message equal to existing one keeps commit untouched
+        if message is None or message.strip() == original_message.strip():
+            message = original_message
+        else:
+            message = message.strip() + '\n'
+        return self.commit_tree(tree, [onto], message, author_env(headers))
+
+    def merge(self, base: str, onto: str, commit: str) -> str:
+        """Three-way merges trees of `onto` and `commit` using `base` as merge-base, returns resulting tree."""
+        if not self.supported():
+            raise ReplayConflict('git merge-tree does not support ' + WRITE_TREE_OPTION)
+        if MERGE_BASE_OPTION in self.options and base:
+            args = ['merge-tree', WRITE_TREE_OPTION, MERGE_BASE_OPTION + '=' + base, onto, commit]
+        else:
+            # commits which only common ancestor has tree of `base`, so merge-tree picks it as merge-base
+            synthetic_base = self.commit_tree(self.tree_of(base) if base else EMPTY_TREE, [], 'replay base')
+            ours = self.commit_tree(self.tree_of(onto), [synthetic_base], 'replay onto')
+            theirs = self.commit_tree(self.tree_of(commit), [synthetic_base], 'replay commit')
+            args = ['merge-tree', WRITE_TREE_OPTION, ours, theirs]
+        result = self.git.run(args, check=False)
+        if result.returncode == 1:
+            raise ReplayConflict(result.stdout)
+        if result.returncode != 0:
+            raise git_client.GitError(['git'] + args, result.returncode, result.stdout, result.stderr)
+        return result.stdout.splitlines()[0]
+
+    def commit_tree(self, tree: str, parents: [str], message: str, env: {} = None) -> str:
+        args = ['commit-tree', tree]
+        for parent in parents:
+            args.extend(['-p', parent])
+        args.extend(['-F', '-'])
+        return self.git.output(args, input=message, env=env).strip()
+
+    def tree_of(self, commit: str) -> str:
+        return self.git.resolve([commit + '^{tree}'])[0]
+
+    def rev_parse(self, revision: str) -> str:
+        return self.git.resolve([revision + '^{commit}'])[0]
+
+    def read_commit(self, commit: str) -> ({}, str):
+        """Returns headers (name to list of values) and message of raw commit object."""
+        found = self.git.read_objects([commit + '^{commit}'])[0]
+        if found is None:
+            raise git_client.GitError(['git', 'cat-file', 'commit', commit], 128)
+        raw = found[2].decode(errors='replace')
+        header, _, message = raw.partition('\n\n')
+        headers = {}
+        for line in header.splitlines():
+            if line.startswith(' '):  # continuation of multiline header (gpgsig)
+                continue
+            key, _, value = line.partition(' ')
+            headers.setdefault(key, []).append(value)
+        return headers, message
+
+
+def author_env(headers: {}) -> {}:
+    """Environment making git record author of commit with given headers."""
+    name, email, date = parse_identity(headers['author'][0])
+    return dict(os.environ, GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=email, GIT_AUTHOR_DATE='@' + date)
+
+
+def parse_identity(identity: str) -> (str, str, str):
+    """Splits `Name <email> 1700000000 +0000` into name, email and raw date."""
+    name, _, rest = identity.partition(' <')
+    email, _, date = rest.partition('> ')
+    return name, email, date
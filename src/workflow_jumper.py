@@ -2,9 +2,15 @@ from __future__ import print_function
 
 import os
 import sys
+import branch_index
+import branch_metadata
+import git_client
+import git_refs
 import workflow_updater
 from queue import Queue
-from branch_filter import BranchFilter
+from branch_filter import BranchFilter, SOURCE_LOCAL, SOURCE_REMOTE, create_tracking_branch
+
+REMOTE_ARGS = ['-r', '--remote']
 
 CWD = os.path.abspath('')
 
@@ -19,8 +25,8 @@ def mixed_input(params_queue):
 def extract_branches(builder_config) -> [dict]:
     builder = workflow_updater.WorkflowBuilder(builder_config, CWD)
     shadow_branches = []
-    for item in builder.config:
-        branch = item['output_branch']
+    for branch in builder.index.outputs():
+        item = builder.index.items_of(branch)[-1]  # branch built several times ends up as its last item
         for i, commit_content in enumerate(reversed(item['branch_contents'])):
             intermediate = {
                     'title': '  * shadow/'+branch+'/'+str(i),
@@ -45,20 +51,54 @@ def find_shadow_branch(branch: str, backing_branches: [dict]) -> dict:
 
 def prepare_shadow_branch(branch: dict):
     # TODO: could be better
-    os.system('cd '+CWD+' && git checkout -b '+branch['name']+' '+branch['ref'])
+    git_client.for_repo(CWD).call(['checkout', '-b', branch['name'], branch['ref']])
     pass
 
 
+def resolve_fast(query: str, shadow_branches: [dict], source: str) -> (str, str):
+    """Resolves query by branch names only, returns `(branch, message)` or `(None, None)` if query is ambiguous."""
+    if len(shadow_branches) > 0 and source == SOURCE_LOCAL:
+        names = list(map(lambda b: b['name'], shadow_branches))
+    else:
+        prefix = git_refs.REMOTE_PREFIX if source == SOURCE_REMOTE else git_refs.LOCAL_PREFIX
+        names = list(git_refs.RefReader(CWD).branches(prefix).keys())
+        names.extend(map(lambda b: b['name'], shadow_branches))
+    branch = branch_index.resolve_by_name(query, names)
+    if not branch:
+        return None, None
+
+    shadow_branch = find_shadow_branch(branch, shadow_branches)
+    if shadow_branch and shadow_branch['commit']:
+        return branch, shadow_branch['commit']
+    revision = shadow_branch['ref'] if shadow_branch else branch
+    meta = branch_metadata.resolve_revisions(CWD, [revision])[revision]
+    return branch, meta.subject if meta else branch_metadata.BRANCH_NOT_FOUND
+
+
 def main(args: [str]) -> None:
     builder_branches: [str] = None
     shadow_branches: [dict] = []
+    source = SOURCE_LOCAL
+    if args and args[0] in REMOTE_ARGS:
+        source = SOURCE_REMOTE
+        args = args[1:] if len(args) > 1 else None
+    queries = args if args else []
     if args and len(args) > 0 and os.path.isfile(args[0]):
         shadow_branches = extract_branches(args[0])
+        queries = args[1:]
+
+    if len(queries) > 0:
+        selected_branch, message = resolve_fast(queries[0], shadow_branches, source)
+        if selected_branch:
+            checkout(selected_branch, message, shadow_branches,
+                     as_local_branch=lambda b: create_tracking_branch(b, CWD) if source == SOURCE_REMOTE else b)
+            return
 
     if args is None:
         branch_filter = BranchFilter(
             custom_branches=None,
-            synthetic_branches=shadow_branches
+            synthetic_branches=shadow_branches,
+            source=source
         )
     else:
         arg_queue = Queue()
@@ -67,16 +107,24 @@ def main(args: [str]) -> None:
 
         branch_filter = BranchFilter(custom_branches=builder_branches,
                                      synthetic_branches=shadow_branches,
-                                     input_provider=lambda: mixed_input(arg_queue))
+                                     input_provider=lambda: mixed_input(arg_queue),
+                                     source=source)
 
-    checkout_branch = branch_filter.find_one()
+    selected_branch = branch_filter.find_one()
+    checkout(selected_branch, branch_filter.head_commits[selected_branch], shadow_branches,
+             as_local_branch=branch_filter.as_local_branch)
 
-    shadow_branch = find_shadow_branch(checkout_branch, shadow_branches)
+
+def checkout(selected_branch: str, message: str, shadow_branches: [dict], as_local_branch) -> None:
+    shadow_branch = find_shadow_branch(selected_branch, shadow_branches)
     if shadow_branch:
         prepare_shadow_branch(shadow_branch)
-    os.system('git checkout ' + checkout_branch)
-    print("With message: '" + branch_filter.head_commits[checkout_branch]+"'")
-    pass
+    checkout_branch = as_local_branch(selected_branch)
+    if checkout_branch is None:
+        print('Checkout cancelled!')
+        return
+    git_client.for_repo(CWD).call(['checkout', checkout_branch])
+    print("With message: '" + message + "'")
 
 
 if __name__ == '__main__':
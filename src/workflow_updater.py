@@ -1,10 +1,24 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import heapq
+import json
 import os
-import subprocess
+import sys
+import threading
 import yaml
+import build_scheduler
+import build_timings
 import cherry_picker
+import git_client
+import tracing
+from git_refs import find_git_dir
+from revision_resolver import RevisionResolver, branch_of
+from scratch_worktree import ScratchWorktree
+from tree_picker import TreeReplayer, ReplayConflict
 from typing import Callable
 
 CWD = os.path.abspath('')
@@ -19,15 +33,74 @@ BR_CONTENT_MSG = cherry_picker.CONTENT_MESSAGE
 CONFIG_BRANCH_CONTENT_COMMIT = 'commit'
 CONFIG_BRANCH_CONTENT_MESSAGE = 'message'
 
+# parsed configs are cached under `.git/git-tools`, keyed also by this file so parser changes invalidate them
+CONFIG_CACHE_DIR = 'git-tools'
+CONFIG_CACHE_PREFIX = 'config_'
+# libyaml based loader is several times faster than pure python one
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
 
 def load_yaml(yaml_config:str) -> dict:
     with open(yaml_config, 'r') as config_file:
         try:
-            return yaml.load(config_file, Loader=yaml.FullLoader)
+            return yaml.load(config_file, Loader=YAML_LOADER)
         except yaml.YAMLError as exc:
             raise Exception(exc)
 
 
+class ConfigIndex:
+    """Adjacency index of parsed config: output branch to its items and basement to items built on top of it."""
+
+    def __init__(self, config: [{}]) -> None:
+        self.config = config
+        self._by_output = {}
+        self._dependents = {}
+        for position, item in enumerate(config):
+            self._by_output.setdefault(item[OUTPUT], []).append(position)
+            self._dependents.setdefault(item[BASEMENT], []).append(position)
+
+    def items_of(self, branch: str) -> [{}]:
+        """Returns items building `branch` (normally single one) in config order."""
+        return list(map(lambda p: self.config[p], self._by_output.get(branch, [])))
+
+    def outputs(self) -> [str]:
+        """Returns branches built by config, each once, in config order."""
+        return list(self._by_output.keys())
+
+    def affected(self, branch: str) -> [{}]:
+        """Returns items to rebuild once `branch` changed: all built on top of it directly or transitively.
+
+        Every item is returned once, each after items building its basement (ties keep config order).
+        """
+        affected = set()
+        pending = list(self._dependents.get(branch, []))
+        while len(pending) > 0:
+            position = pending.pop()
+            if position in affected:
+                continue
+            affected.add(position)
+            pending.extend(self._dependents.get(self.config[position][OUTPUT], []))
+
+        # Kahn's algorithm over affected items, an item waits for affected items building its basement
+        waiting = dict(map(lambda p: (p, len(list(filter(lambda b: b in affected,
+                                                          self._by_output.get(self.config[p][BASEMENT], []))))),
+                           affected))
+        ready = list(filter(lambda p: waiting[p] == 0, affected))
+        heapq.heapify(ready)
+        ordered = []
+        while len(ready) > 0:
+            position = heapq.heappop(ready)
+            ordered.append(position)
+            for dependent in self._dependents.get(self.config[position][OUTPUT], []):
+                if dependent in waiting and waiting[dependent] > 0:
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0:
+                        heapq.heappush(ready, dependent)
+        # items of dependency cycle never become ready, they are built last in config order
+        ordered.extend(sorted(affected - set(ordered)))
+        return list(map(lambda p: self.config[p], ordered))
+
+
 class WorkflowBuilder:
     def __init__(self,
                  yaml_config: str,
@@ -36,7 +109,11 @@ class WorkflowBuilder:
                  force_update: bool = False,
                  dry_run: bool = False,
                  quiet: bool = False,
-                 log_file = LOG_FILE) -> None:
+                 log_file = LOG_FILE,
+                 in_memory: bool = False,
+                 scratch: bool = False,
+                 jobs: int = 1,
+                 raw_config: [] = None) -> None:
         super().__init__()
         self.yaml_config = yaml_config
         self.input_provider = input_provider
@@ -44,43 +121,205 @@ class WorkflowBuilder:
         self.dry_run = dry_run
         self.quiet = quiet
         self.cwd = cwd
+        self.git = git_client.for_repo(cwd)
         self.log_file = log_file
-        self.config = self.parse_yaml(load_yaml(yaml_config))
-
-    def start_flow(self):
+        self.in_memory = in_memory
+        self.scratch = scratch
+        self.jobs = jobs
+        self.affected = []  # branches rebuilt by last flow
+        self.config = self.parse_yaml(raw_config) if raw_config is not None else self.load_config(yaml_config)
+        self.index = ConfigIndex(self.config)
+
+    def start_flow(self) -> bool:
+        """Builds all branches of config, returns False when build was not started or got cancelled."""
         if self.has_uncommited_changes():
             if not self.try_commit_changes():
                 print('Please commit or stash changes before building!')
-                return
+                return False
         self.log('\n==== Updating branches at: {} ===='.format(self.cwd))
-        self.process_items(self.config)
+        with tracing.span('flow'):
+            return self.process_items(self.config)
 
     def process_items(self, config_items: []):
+        if self.jobs > 1:
+            if self.dry_run:
+                print('Building sequentially, --jobs is not supported with --dry-run')
+            elif not TreeReplayer(self.cwd).supported():
+                print('Building sequentially, --jobs needs git with "merge-tree --write-tree" (git 2.38+)')
+            else:
+                return self.process_items_in_parallel(config_items)
         affected = []
 
         flow_start = datetime.datetime.now()
+        resolver = RevisionResolver(self.cwd)
+        with tracing.span('preflight'):
+            self.preflight(config_items, resolver)
+        timings = build_timings.BuildTimings(self.cwd)
+        with tracing.span('scratch worktree'):
+            build_cwd = ScratchWorktree(self.cwd).prepare() if self.scratch else self.cwd
 
         for item in config_items:
             target_branch: str = item[OUTPUT]
             basement_branch: str = item[BASEMENT]
             contents: [object] = item[BRANCH_CONTENTS]
             picker = cherry_picker.Picker(target_branch=target_branch, basement_branch=basement_branch,
-                                          branch_contents=contents, cwd=self.cwd, log_file=self.log_file,
+                                          branch_contents=contents, cwd=build_cwd, log_file=self.log_file,
                                           input_provider=self.input_provider, verbose_ouput=not self.quiet, dry_run=self.dry_run,
-                                          assume_assembled_properly=self.quiet, fallback_branch=basement_branch)
+                                          assume_assembled_properly=self.quiet, fallback_branch=basement_branch,
+                                          in_memory=self.in_memory, resolver=resolver, scratch=self.scratch)
 
             if not self.force_update and picker.up_to_date():
                 print('Branch "' + picker.target_branch + '" already up-to-date with basement "' +
                       picker.basement_branch + '"')
                 continue
 
+            build_start = datetime.datetime.now()
             result = picker.run()
 
             if result:
                 affected.append(target_branch)
+                if self.quiet:  # interactive builds are timed together with answers
+                    timings.record(target_branch, (datetime.datetime.now() - build_start).total_seconds(),
+                                   len(contents))
             else:
                 print('Building cancelled!')
-                return
+                self.affected = affected
+                timings.save()
+                return False
+        timings.save()
+        self.report(flow_start, affected)
+        return True
+
+    def process_items_in_parallel(self, config_items: []):
+        """Builds independent chains of config concurrently with in-memory engine, without questions.
+
+        Items are ordered inside each chain, so build takes as long as the longest chain. Item which can not be
+        replayed (conflict) fails together with its dependents, they should be rebuilt sequentially.
+        """
+        flow_start = datetime.datetime.now()
+        resolver = RevisionResolver(self.cwd)
+        with tracing.span('preflight'):
+            self.preflight(config_items, resolver)
+        depends_on = build_scheduler.dependencies(
+            list(map(lambda item: item[OUTPUT], config_items)),
+            list(map(lambda item: build_scheduler.branches_read(
+                item[BASEMENT], list(map(lambda c: c[BR_CONTENT_COMMIT], item[BRANCH_CONTENTS]))), config_items)))
+        affected = []
+        timings = build_timings.BuildTimings(self.cwd)
+
+        def build(index: int) -> bool:
+            with tracing.span('assemble', branch=config_items[index][OUTPUT]):
+                return replay(index)
+
+        def replay(index: int) -> bool:
+            item = config_items[index]
+            picker = cherry_picker.Picker(target_branch=item[OUTPUT], basement_branch=item[BASEMENT],
+                                          branch_contents=item[BRANCH_CONTENTS], cwd=self.cwd, log_file=self.log_file,
+                                          input_provider=self.input_provider, verbose_ouput=False,
+                                          assume_assembled_properly=True, in_memory=True, resolver=resolver)
+            try:
+                if not self.force_update and picker.up_to_date():
+                    print('Branch "' + picker.target_branch + '" already up-to-date with basement "' +
+                          picker.basement_branch + '"')
+                    return True
+                build_start = datetime.datetime.now()
+                head, replayed = picker.replay_in_memory()
+                if replayed < len(picker.branches_to_cherry_pick):
+                    print('Failed to cherry-pick "' + picker.branches_to_cherry_pick[replayed] + '" in memory, ' +
+                          'build "' + picker.target_branch + '" without --jobs to resolve conflicts')
+                    return False
+                if not picker.update_target(head):
+                    return False
+            except Exception as e:
+                print('Failed to build "' + picker.target_branch + '": ' + str(e))
+                return False
+            timings.record(picker.target_branch, (datetime.datetime.now() - build_start).total_seconds(), replayed)
+            affected.append(index)
+            return True
+
+        states = build_scheduler.run_graph(list(range(len(config_items))), depends_on, build, self.jobs)
+        timings.save()
+        for index, state in states.items():
+            if state != build_scheduler.DONE:
+                print('Branch "' + config_items[index][OUTPUT] + '" ' + state)
+        self.report(flow_start, list(map(lambda i: config_items[i][OUTPUT], sorted(affected))))
+        return all(map(lambda state: state == build_scheduler.DONE, states.values()))
+
+    def plan(self, predict_conflicts: bool = False) -> {}:
+        """Computes which branches build would rebuild and why, without touching working tree, refs or objects.
+
+        Revisions of whole config are resolved in one batch. With `predict_conflicts` stale branches are replayed
+        in object database (when git supports `merge-tree --write-tree`) to predict conflicts, dependents are
+        replayed on top of predicted heads of their basements. Replayed commits stay unreachable until `git gc`.
+        """
+        resolver = RevisionResolver(self.cwd)
+        revisions = []
+        for item in self.config:
+            contents = list(map(lambda c: c[BR_CONTENT_COMMIT], item[BRANCH_CONTENTS]))
+            revisions.extend([item[OUTPUT], item[OUTPUT] + '~' + str(len(contents)), item[BASEMENT]] + contents)
+        resolved = resolver.resolve(revisions)
+        replayer = TreeReplayer(self.cwd) if predict_conflicts else None
+        timings = build_timings.BuildTimings(self.cwd)
+
+        items = []
+        predicted_heads = {}  # branch to its head after build, None when it can not be predicted
+        for item in self.config:
+            contents = list(map(lambda c: c[BR_CONTENT_COMMIT], item[BRANCH_CONTENTS]))
+            messages = list(map(lambda c: c.get(BR_CONTENT_MSG, None), item[BRANCH_CONTENTS]))
+            missing = list(filter(lambda r: resolved[r] is None and branch_of(r) not in predicted_heads,
+                                  [item[BASEMENT]] + contents))
+            picker = cherry_picker.Picker(target_branch=item[OUTPUT], basement_branch=item[BASEMENT],
+                                          branch_contents=item[BRANCH_CONTENTS], cwd=self.cwd, resolver=resolver)
+            if len(missing) > 0:
+                reason = 'missing revisions: ' + ', '.join(missing)
+            elif item[BASEMENT] in predicted_heads:
+                reason = 'basement will be rebuilt (' + item[BASEMENT] + ')'
+            elif self.force_update:
+                reason = 'forced'
+            else:
+                reason = picker.staleness()
+
+            conflict = None
+            checked = False
+            if reason is not None and len(missing) == 0 and replayer and replayer.supported():
+                head = predicted_heads.get(item[BASEMENT], resolved[item[BASEMENT]])
+                for i, content in enumerate(contents):
+                    if head is None or branch_of(content) in predicted_heads:  # picks from branch rebuilt earlier
+                        head = None
+                        break
+                    try:
+                        head = replayer.replay(head, resolved[content], messages[i])
+                    except ReplayConflict:
+                        conflict = content
+                        head = None
+                        break
+                checked = head is not None or conflict is not None
+                predicted_heads[item[OUTPUT]] = head
+            elif reason is not None:
+                predicted_heads[item[OUTPUT]] = None
+
+            items.append({
+                'branch': item[OUTPUT],
+                'basement': item[BASEMENT],
+                'rebuild': reason is not None,
+                'reason': reason,
+                'commits': len(contents),
+                'conflicts_checked': checked,
+                'conflict': conflict,
+                'estimated_seconds': timings.estimate(item[OUTPUT], len(contents)) if reason is not None else 0,
+            })
+
+        rebuilt = list(filter(lambda i: i['rebuild'], items))
+        estimates = list(map(lambda i: i['estimated_seconds'], rebuilt))
+        return {
+            'cwd': self.cwd,
+            'rebuild': list(map(lambda i: i['branch'], rebuilt)),
+            'estimated_seconds': sum(estimates) if None not in estimates else None,
+            'items': items,
+        }
+
+    def report(self, flow_start: datetime.datetime, affected: [str]):
+        self.affected = affected
         flow_end = datetime.datetime.now()
         flow_seconds = (flow_end - flow_start).total_seconds()
         seconds = str(round(flow_seconds, 1))
@@ -95,8 +334,61 @@ class WorkflowBuilder:
 
         print('')
 
+    def preflight(self, config_items: [], resolver: RevisionResolver) -> None:
+        """Resolves all revisions of config with single batch and fails on missing ones before any branch is touched.
+
+        Revisions of branches built by earlier items may be missing yet, they are resolved again once built.
+        """
+        revisions = []
+        for item in config_items:
+            contents = list(map(lambda c: c[BR_CONTENT_COMMIT], item[BRANCH_CONTENTS]))
+            # target and its expected basement are only needed for up-to-date check, so they may be missing
+            revisions.extend([item[OUTPUT], item[OUTPUT] + '~' + str(len(contents)), item[BASEMENT]] + contents)
+        resolved = resolver.resolve(revisions)
+
+        built = set()
+        missing = []
+        for item in config_items:
+            required = [item[BASEMENT]] + list(map(lambda c: c[BR_CONTENT_COMMIT], item[BRANCH_CONTENTS]))
+            missing.extend(filter(lambda r: resolved[r] is None and branch_of(r) not in built, required))
+            built.add(item[OUTPUT])
+        if len(missing) > 0:
+            raise Exception('Failed to resolve revisions of config: ' + ', '.join(dict.fromkeys(missing)))
+
+    def load_config(self, yaml_config: str) -> [dict]:
+        """Returns parsed config, cached under `.git` until yaml or parser changes (parsing also depends on cwd)."""
+        try:
+            stat = os.stat(yaml_config)
+            parser = os.stat(__file__)
+            cache_path = config_cache_path(yaml_config, self.cwd)
+        except Exception:  # missing yaml is reported by parsing, cwd outside of repository is not cached
+            return self.parse_yaml(load_yaml(yaml_config))
+        key = {'path': os.path.abspath(yaml_config), 'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+               'parser': [parser.st_mtime_ns, parser.st_size]}
+        configs = {}
+        try:
+            with open(cache_path) as f:
+                data = json.load(f)
+            if data.get('key', None) == key:
+                configs = data.get('configs', {})
+        except (OSError, ValueError):
+            pass
+        if self.cwd in configs:
+            return configs[self.cwd]
+
+        configs[self.cwd] = self.parse_yaml(load_yaml(yaml_config))
+        tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, mode='w') as f:
+                json.dump({'key': key, 'configs': configs}, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # cache is best effort, yaml is parsed again next time
+        return configs[self.cwd]
+
     def has_uncommited_changes(self) -> bool:
-        output = subprocess.check_output('git status --short --untracked-files=no', cwd=self.cwd, universal_newlines=True, shell=True)
+        output = self.git.output(['status', '--short', '--untracked-files=no'])
         return output.replace('\n', '') != ''
 
     def parse_yaml(self, config: dict) -> [dict]:
@@ -189,17 +481,17 @@ class WorkflowBuilder:
     def start(self):
         current_branch = self.capture_current_branch()
         self.start_flow()
+        if self.scratch:  # user's checkout was not touched
+            return
         print('Returning back...')
-        os.system('git checkout ' + current_branch)
+        git_client.for_repo(CWD).call(['checkout', current_branch])
 
     def capture_current_branch(self) -> str:
-        cmd = 'git rev-parse --abbrev-ref HEAD'
-        output = subprocess.check_output(cmd, cwd=self.cwd, universal_newlines=True, shell=True)
-        return str(output.splitlines()[0])
+        return self.git.lines(['rev-parse', '--abbrev-ref', 'HEAD'])[0]
 
     def try_commit_changes(self) -> bool:
         current_branch = self.capture_current_branch()
-        current_branch_configs = list(filter(lambda e: e[OUTPUT] == current_branch, self.config))
+        current_branch_configs = self.index.items_of(current_branch)
 
         if len(current_branch_configs) != 1:
             return False
@@ -218,18 +510,13 @@ class WorkflowBuilder:
         if not can_commit_to_head:
             return False
 
-        def get_commit_hash(commit_link: str) -> str:
-            cmd = 'git rev-parse ' + commit_link
-            output = subprocess.check_output(cmd, cwd=self.cwd, universal_newlines=True, shell=True)
-            return str(output.splitlines()[0])
-
-        head_commit_hash = get_commit_hash(head_content_desc[BR_CONTENT_COMMIT])
-        basement_commit_hash = get_commit_hash(branch_config[BASEMENT])
+        head_commit_hash, basement_commit_hash = self.git.resolve([head_content_desc[BR_CONTENT_COMMIT],
+                                                                   branch_config[BASEMENT]])
 
         should_amend = head_commit_hash != basement_commit_hash
 
         print('Got uncommitted changes:')
-        os.system('cd ' + self.cwd + ' && git status')
+        self.git.call(['status'])
 
         if should_amend:
             question = 'Amend all of them to head commit with message "'+head_content_desc[BR_CONTENT_MSG]+'"?'
@@ -239,26 +526,104 @@ class WorkflowBuilder:
         if cherry_picker.query_yes_no(question, self.input_provider, default='yes') != 'yes':
             return False
 
-        amend = ''
-        if should_amend:
-            amend = '--amend'
-        print(self.run_cmd('git commit '+amend+' --all --message="' + head_content_desc[BR_CONTENT_MSG] + '"'))
+        amend = ['--amend'] if should_amend else []
+        print(self.git.output(['commit'] + amend + ['--all', '--message=' + head_content_desc[BR_CONTENT_MSG]]))
         return True
 
 
-    def run_cmd(self, command) -> str:
-        with subprocess.Popen(command,
-                              shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              universal_newlines=True,
-                              cwd=self.cwd) as p:
-            retcode = p.wait()
-            if retcode != 0:
-                raise Exception('failed to execute command:' + command + "\nOutput:\n" +
-                          '\n'.join(p.stdout.readlines()) + '\n' +
-                          '\n'.join(p.stderr.readlines()))
-            return ''.join(p.stdout.readlines())
+def config_cache_path(yaml_config: str, cwd: str) -> str:
+    """Returns cache of parsed `yaml_config` in repository containing `cwd`, one file per config."""
+    name = hashlib.sha1(os.path.abspath(yaml_config).encode()).hexdigest()[:16]
+    return os.path.join(find_git_dir(cwd), CONFIG_CACHE_DIR, CONFIG_CACHE_PREFIX + name + '.json')
+
+
+def load_workspace(yaml_config: str) -> [(str, [])]:
+    """Groups long-form nodes of multi-repo config by repository, returns `(repo, nodes)` pairs in config order.
+
+    Every node has to name its repo, nodes without it would be silently skipped by every repository build.
+    """
+    workspace = {}
+    for node in load_yaml(yaml_config):
+        if not isinstance(node, dict) or 'repo' not in node:
+            raise Exception('Node without "repo" can not be built in workspace mode: ' + str(node))
+        workspace.setdefault(node['repo'], []).append(node)
+    return list(workspace.items())
+
+
+@contextlib.contextmanager
+def prefixed_output(prefix: str):
+    """Prefixes every line written to stdout (by python or spawned git) until exit, lines are written whole."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    read_end, write_end = os.pipe()
+    os.dup2(write_end, 1)
+    os.close(write_end)
+
+    def pump():
+        with os.fdopen(read_end, errors='replace') as lines, os.fdopen(os.dup(saved), mode='w') as out:
+            for line in lines:
+                out.write(prefix + line)
+                out.flush()
+
+    pumping = threading.Thread(target=pump, daemon=True)
+    pumping.start()
+    # sys.stdout may be replaced (tests capture it), so python output is written to new fd 1 explicitly
+    with os.fdopen(os.dup(1), mode='w', buffering=1) as stdout:
+        try:
+            with contextlib.redirect_stdout(stdout):
+                yield
+        finally:
+            stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+    pumping.join()  # every write end of pipe is closed, so pump reaches its end
+
+
+def build_repo(repo: str, nodes: [], yaml_config: str, force_update: bool = False, in_memory: bool = False) -> {}:
+    """Non-interactive build of single repo of workspace, returns its report; conflicts cancel the build."""
+    report = {'repo': repo, 'affected': [], 'error': None}
+    build_start = datetime.datetime.now()
+    with prefixed_output(os.path.basename(repo.rstrip('/')) + ': '):
+        try:
+            builder = WorkflowBuilder(yaml_config=yaml_config, cwd=os.path.abspath(repo), input_provider=lambda: 'no',
+                                      force_update=force_update, quiet=True, in_memory=in_memory, raw_config=nodes)
+            current_branch = builder.capture_current_branch()
+            if not builder.start_flow():
+                report['error'] = 'build was not completed'
+            builder.git.run(['checkout', '--quiet', current_branch], check=False)
+            report['affected'] = builder.affected
+        except Exception as exc:
+            report['error'] = str(exc).strip()
+    report['seconds'] = (datetime.datetime.now() - build_start).total_seconds()
+    return report
+
+
+def build_workspace(yaml_config: str, jobs: int = None, force_update: bool = False, in_memory: bool = False) -> [{}]:
+    """Builds every repository of multi-repo config in bounded process pool, reports are in config order."""
+    repos = load_workspace(yaml_config)
+    if len(repos) == 0:
+        return []
+    jobs = min(jobs or os.cpu_count() or 1, len(repos))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = list(map(lambda r: pool.submit(build_repo, r[0], r[1], yaml_config, force_update, in_memory),
+                           repos))
+        return list(map(lambda f: f.result(), futures))
+
+
+def print_workspace_report(reports: [{}], seconds: float) -> None:
+    width = max(map(lambda r: len(r['repo']), reports), default=0)
+    for report in reports:
+        if report['error']:
+            status = 'FAILED: ' + report['error'].splitlines()[0]
+        elif len(report['affected']) == 0:
+            status = 'up-to-date'
+        else:
+            status = 'rebuilt ' + ', '.join(report['affected'])
+        print(report['repo'].ljust(width) + '  ' + str(round(report['seconds'], 1)).rjust(5) + 's  ' + status)
+    affected = sum(map(lambda r: len(r['affected']), reports))
+    failed = len(list(filter(lambda r: r['error'], reports)))
+    print('\nRebuilt ' + str(affected) + ' branches in ' + str(len(reports)) + ' repos, ' + str(failed) +
+          ' failed, overall build took: ' + str(round(seconds, 1)) + 's')
 
 
 if __name__ == '__main__':
@@ -271,25 +636,63 @@ if __name__ == '__main__':
                         help='starts building process at temporary branches and does not perform any changes to real branches')
     parser.add_argument('--quiet', action='store_true',
                         help='will not ask questions during building process (except failed chery-picks)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='replays commits without checkouts, working tree is used only to resolve conflicts')
+    parser.add_argument('--scratch', action='store_true',
+                        help='builds in reusable worktree under .git, current checkout is never changed')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='builds up to JOBS independent chains at once in memory, without questions '
+                             '(with --workspace: up to JOBS repositories at once, default: number of CPUs)')
+    parser.add_argument('--plan', action='store_true',
+                        help='prints JSON plan of rebuild (reasons, conflicts, estimated time) without building')
+    parser.add_argument('--predict-conflicts', action='store_true',
+                        help='with --plan: replays stale branches in object database to predict conflicts '
+                             '(leaves unreachable objects until git gc)')
+    parser.add_argument('--workspace', action='store_true',
+                        help='builds every "repo" of multi-repo config in parallel, without questions')
+    parser.add_argument('--trace', metavar='FILE', type=str,
+                        help='writes timings of every git step to FILE (Chrome trace, JSONL for *.jsonl) '
+                             'and prints the slowest ones')
 
     args = parser.parse_args()
-
-    WorkflowBuilder(
-        yaml_config=args.config_file,
-        cwd=CWD,
-        force_update=args.force,
-        dry_run=args.dry_run,
-        quiet=args.quiet
-    ).start()
+    if args.predict_conflicts and not args.plan:
+        parser.error('--predict-conflicts requires --plan')
+    if args.jobs and args.jobs > 1 and args.dry_run and not args.workspace:
+        parser.error('--jobs can not be combined with --dry-run')
+
+    if args.workspace:
+        ignored = list(filter(lambda e: e[1], [('--dry-run', args.dry_run), ('--quiet', args.quiet),
+                                                ('--scratch', args.scratch), ('--plan', args.plan),
+                                                ('--trace', args.trace)]))
+        if len(ignored) > 0:
+            parser.error('--workspace does not support ' + ', '.join(map(lambda e: e[0], ignored)))
+        workspace_start = datetime.datetime.now()
+        reports = build_workspace(args.config_file, jobs=args.jobs,
+                                  force_update=args.force, in_memory=args.in_memory)
+        print_workspace_report(reports, (datetime.datetime.now() - workspace_start).total_seconds())
+        sys.exit(1 if any(map(lambda r: r['error'], reports)) else 0)
+
+    if args.plan:
+        builder = WorkflowBuilder(yaml_config=args.config_file, cwd=CWD, force_update=args.force)
+        print(json.dumps(builder.plan(predict_conflicts=args.predict_conflicts), indent=2))
+        sys.exit(0)
+
+    tracer = tracing.start() if args.trace else None
+    try:
+        WorkflowBuilder(
+            yaml_config=args.config_file,
+            cwd=CWD,
+            force_update=args.force,
+            dry_run=args.dry_run,
+            quiet=args.quiet,
+            in_memory=args.in_memory,
+            scratch=args.scratch,
+            jobs=args.jobs or 1
+        ).start()
+    finally:
+        if tracer:
+            tracing.stop()
+            tracer.export(args.trace)
+            tracer.print_summary()
 pass
 
-
-def filter_affected(branch: str, config: [{}]) -> [{}]:
-    results = []
-    for c in config:
-        if c['basement_branch'] == branch:
-            results.append(c)
-
-    for r in results:
-        results.extend(filter_affected(branch=r['output_branch'], config=config))
-    return results